@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+import time
+
+import fastavro
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics  # noqa: E402
+from magstats_step.scribe import AvroPayloadEncoder, JsonPayloadEncoder  # noqa: E402
+from magstats_step.step import MagstatsStep  # noqa: E402
+from magstats_step.synthetic import generate_messages  # noqa: E402
+
+SCHEMAS = {"json": "scribe_schema.avsc", "avro": "scribe_schema_compact.avsc"}
+
+
+def build_commands(n_objects: int) -> list:
+    messages = MagstatsStep.pre_execute(generate_messages(n_objects, n_detections=20, seed=42))
+    stats = ObjectStatistics(messages["detections"]).generate_statistics()
+    magstats = MagnitudeStatistics(**messages).generate_statistics()
+    result = MagstatsStep.assemble(stats, magstats)
+    return [MagstatsStep.build_command(aid, obj) for aid, obj in result.items()]
+
+
+def benchmark(name: str, encoder, commands: list):
+    schema = fastavro.parse_schema(fastavro.schema.load_schema(SCHEMAS[name]))
+    start = time.perf_counter()
+    messages = [encoder.encode(command) for command in commands]
+    encode_time = time.perf_counter() - start
+
+    size = 0
+    for message in messages:  # Size of the message as serialized by the producer, without container header
+        out = io.BytesIO()
+        fastavro.schemaless_writer(out, schema, message)
+        size += len(out.getvalue())
+
+    start = time.perf_counter()
+    for message in messages:
+        encoder.decode(message)
+    decode_time = time.perf_counter() - start
+
+    n = len(commands)
+    print(
+        f"{name:>5}: {size / n:8.1f} bytes/object, "
+        f"encode {1e6 * encode_time / n:7.1f} us/object, decode {1e6 * decode_time / n:7.1f} us/object"
+    )
+
+
+if __name__ == "__main__":
+    n_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    commands = build_commands(n_objects)
+    print(f"{len(commands)} objects")
+    benchmark("json", JsonPayloadEncoder(), commands)
+    benchmark("avro", AvroPayloadEncoder(), commands)
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from magstats_step.step import MagstatsStep  # noqa: E402
+
+
+def run(n_messages: int, batch_size: int, n_detections: int) -> dict:
+    config = {
+        "CONSUMER_CONFIG": {
+            "CLASS": "magstats_step.inmemory.InMemoryConsumer",
+            "N_MESSAGES": n_messages,
+            "BATCH_SIZE": batch_size,
+            "N_DETECTIONS": n_detections,
+        },
+        "SCRIBE_PRODUCER_CONFIG": {"CLASS": "magstats_step.inmemory.InMemoryProducer", "KEEP_MESSAGES": False},
+        "EXCLUDED_CALCULATORS": [],
+    }
+    step = MagstatsStep(config=config)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # The step writes a __SUCCESS__ file when it finishes
+        try:
+            start = time.perf_counter()
+            step.start()
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return step.consumer.report(elapsed)
+
+
+if __name__ == "__main__":
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    n_detections = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    report = run(n_messages, batch_size, n_detections)
+    print(
+        f"{report['messages']} messages in {report['batches']} batches: "
+        f"{report['messages_per_second']:.0f} messages/s, {report['detections_per_second']:.0f} detections/s, "
+        f"p50 {1e3 * report['p50_batch_latency']:.1f} ms, p99 {1e3 * report['p99_batch_latency']:.1f} ms per batch"
+    )
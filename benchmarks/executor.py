@@ -0,0 +1,81 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics  # noqa: E402
+from magstats_step.core._cache import IntermediateCache  # noqa: E402
+from magstats_step.step import MagstatsStep  # noqa: E402
+from magstats_step.synthetic import generate_messages  # noqa: E402
+
+
+class TimedLock:
+    # Adds the time spent waiting to acquire the lock to a shared total
+    def __init__(self, lock, waits: list):
+        self.lock = lock
+        self.waits = waits
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.waits.append(time.perf_counter() - start)
+
+    def __exit__(self, *_):
+        self.lock.release()
+
+
+class TimedCache(IntermediateCache):
+    waits = []
+
+    def _lock(self, key):
+        return TimedLock(super()._lock(key), self.waits)
+
+
+class GlobalLockCache(TimedCache):
+    # Previous behaviour, a single reentrant lock taken on every miss
+    def __init__(self):
+        super().__init__()
+        self._global = threading.RLock()
+
+    def _lock(self, key):
+        return TimedLock(self._global, self.waits)
+
+
+def run(messages: dict, threads: int, repeat: int = 3, cache: type = TimedCache) -> tuple:
+    # Best of several runs, each building the calculators from scratch as the step does, and time waiting on locks
+    executor = ThreadPoolExecutor(threads) if threads else None
+    best, waits = float("inf"), []
+    for _ in range(repeat):
+        cache.waits = []
+        start = time.perf_counter()
+        with mock.patch("magstats_step.core._base.IntermediateCache", cache):
+            calculators = (ObjectStatistics(messages["detections"]), MagnitudeStatistics(**messages))
+        if executor:
+            pending = [calculator.submit_statistics(executor) for calculator in calculators]
+            [collect() for collect in pending]
+        else:
+            [calculator.generate_statistics() for calculator in calculators]
+        best = min(best, time.perf_counter() - start)
+        waits.append(sum(cache.waits))
+    if executor:
+        executor.shutdown()
+    return best, min(waits)
+
+
+if __name__ == "__main__":
+    n_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    messages = MagstatsStep.pre_execute(generate_messages(n_objects, n_detections=20, seed=42))
+    print(f"{n_objects} objects, {len(messages['detections'])} detections, {os.cpu_count()} cores")
+    sequential, _ = run(messages, 0)
+    print(f"sequential: {sequential:.3f} s")
+    for threads in sorted({1, 2, 4, os.cpu_count()}):
+        for name, cache in [("global lock", GlobalLockCache), ("lock per key", TimedCache)]:
+            elapsed, waiting = run(messages, threads, cache=cache)
+            print(
+                f"{threads:>3} threads, {name}: {elapsed:.3f} s, speedup {sequential / elapsed:.2f}x, "
+                f"{waiting:.3f} s waiting on the cache"
+            )
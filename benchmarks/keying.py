@@ -0,0 +1,67 @@
+import itertools
+import os
+import sys
+import time
+import zlib
+
+from apf.producers import GenericProducer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics  # noqa: E402
+from magstats_step.scribe import JsonPayloadEncoder  # noqa: E402
+from magstats_step.step import MagstatsStep  # noqa: E402
+from magstats_step.synthetic import generate_messages  # noqa: E402
+
+
+class PartitionedStubProducer(GenericProducer):
+    # Assigns partitions as Kafka does, by hash of the key when there is one and round robin otherwise
+    n_partitions = 12
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.partitions = [[] for _ in range(self.n_partitions)]
+        self._next = itertools.cycle(range(self.n_partitions))
+
+    def produce(self, message=None, **kwargs):
+        key = message[self.key_field] if self.key_field else None
+        partition = zlib.crc32(key.encode()) % self.n_partitions if key is not None else next(self._next)
+        self.partitions[partition].append((message["aid"], message["payload"]))
+
+
+def build_messages(n_objects: int) -> list:
+    messages = MagstatsStep.pre_execute(generate_messages(n_objects, n_detections=20, seed=42))
+    stats = ObjectStatistics(messages["detections"]).generate_statistics()
+    magstats = MagnitudeStatistics(**messages).generate_statistics()
+    result = MagstatsStep.assemble(stats, magstats)
+    encoder = JsonPayloadEncoder()
+    return [encoder.encode(MagstatsStep.build_command(aid, obj)) | {"aid": aid} for aid, obj in result.items()]
+
+
+def benchmark(name: str, key_field, messages: list, n_batches: int):
+    # Throughput of the producing side only (keys and partitioning), without a broker
+    producer = PartitionedStubProducer({})
+    if key_field:
+        producer.set_key_field(key_field)
+    start = time.perf_counter()
+    for _ in range(n_batches):  # Every object is updated once per batch
+        for message in messages:
+            producer.produce(message)
+    elapsed = time.perf_counter() - start
+
+    partitions = {}
+    for i, partition in enumerate(producer.partitions):
+        for aid, _ in partition:
+            partitions.setdefault(aid, set()).add(i)
+    spread = sum(len(used) for used in partitions.values()) / len(partitions)
+    n = n_batches * len(messages)
+    print(f"{name:>7}: {n / elapsed:10.0f} messages/s, {spread:5.2f} partitions per object")
+
+
+if __name__ == "__main__":
+    n_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    messages = build_messages(n_objects)
+    print(f"{len(messages)} objects, {n_batches} batches, {PartitionedStubProducer.n_partitions} partitions")
+    benchmark("unkeyed", None, messages, n_batches)
+    benchmark("keyed", "aid", messages, n_batches)
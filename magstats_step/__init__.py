@@ -0,0 +1,3 @@
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics, calculate_records, calculate_statistics
+
+__all__ = ["calculate_records", "calculate_statistics", "MagnitudeStatistics", "ObjectStatistics"]
@@ -1,4 +1,6 @@
+from .api import calculate_statistics
+from .fast import calculate_records
 from .magstats import MagnitudeStatistics
 from .objstats import ObjectStatistics
 
-__all__ = ["MagnitudeStatistics", "ObjectStatistics"]
+__all__ = ["calculate_records", "calculate_statistics", "MagnitudeStatistics", "ObjectStatistics"]
@@ -1,36 +1,107 @@
 import abc
+from concurrent.futures import Executor
 from functools import reduce
-from typing import Union, Literal, List, Set, Tuple
+from typing import TYPE_CHECKING, Callable, Iterable, Optional, Union, Literal, List, Set, Tuple
 
+import numpy as np
 import pandas as pd
-from methodtools import lru_cache
 from pandas.core.groupby import DataFrameGroupBy, SeriesGroupBy
 
+from ._cache import IntermediateCache, cached
+
+if TYPE_CHECKING:  # Optional dependency, only imported when converting Arrow tables
+    import pyarrow
+
+# Rows as records, data frames or Arrow tables
+Records = Union[List[dict], pd.DataFrame, "pyarrow.Table"]
+
+
+def requires(*columns: str):
+    # Declares the detection columns read by a calculator, only those of the enabled calculators are ingested
+    def decorator(method):
+        method.columns = columns
+        return method
+
+    return decorator
+
 
 class BaseStatistics(abc.ABC):
     _JOIN: Union[str, List[str]]
     _PREFIX = "calculate_"
     _CORRECTED = ("ZTF",)
     _STELLAR = ("ZTF",)
+    # Columns read by the intermediates shared across calculators, besides the join
+    _COLUMNS = ("candid", "mjd", "sid")
+
+    def __init__(self, detections: Records, exclude: Set[str] = None):
+        self._cache = IntermediateCache()
+        self._exclude = set(exclude or ())  # Calculators never run, their columns are not ingested
+        self._detections = self._project(detections, self._columns())
+        self._detections = self._detections.drop_duplicates("candid").set_index("candid")
 
-    def __init__(self, detections: List[dict]):
+    def _columns(self) -> Optional[Set[str]]:
+        # Union of the columns read by the enabled calculators, None (all columns) if any of them does not declare it
+        columns = {*self._COLUMNS, *([self._JOIN] if isinstance(self._JOIN, str) else self._JOIN)}
+        for method in self._methods():
+            required = getattr(getattr(self, method), "columns", None)
+            if required is None:
+                return None
+            columns.update(required)
+        return columns
+
+    @staticmethod
+    def _keep(names: Iterable[str], columns: Optional[Set[str]]) -> List[str]:
+        return [name for name in names if (name in columns if columns is not None else name != "extra_fields")]
+
+    @classmethod
+    def _project(cls, records: Records, columns: Optional[Set[str]]) -> pd.DataFrame:
+        # Only non-forced detections and the given columns (those present) are converted into the frame
+        if isinstance(records, pd.DataFrame):
+            return records.loc[~records["forced"], cls._keep(records.columns, columns)]
+        if hasattr(records, "to_pandas"):  # Arrow table, split blocks avoid consolidating (copying) the columns
+            import pyarrow.compute
+
+            records = records.filter(pyarrow.compute.invert(records["forced"]))
+            return records.select(cls._keep(records.column_names, columns)).to_pandas(split_blocks=True)
+        names = cls._keep(dict.fromkeys(key for record in records for key in record), columns)
+        return pd.DataFrame.from_records([record for record in records if not record["forced"]], columns=names)
+
+    @staticmethod
+    def _as_frame(records: Records) -> pd.DataFrame:
+        if isinstance(records, pd.DataFrame):
+            return records
+        if hasattr(records, "to_pandas"):  # Arrow table, split blocks avoid consolidating (copying) the columns
+            return records.to_pandas(split_blocks=True)
         try:
-            self._detections = pd.DataFrame.from_records(detections, exclude=["extra_fields"])
+            return pd.DataFrame.from_records(records, exclude=["extra_fields"])
         except KeyError:  # extra_fields is not present
-            self._detections = pd.DataFrame.from_records(detections)
-        self._detections = self._detections.drop_duplicates("candid").set_index("candid")
-        # Select only non-forced detections
-        self._detections = self._detections[~self._detections["forced"]]
+            return pd.DataFrame.from_records(records)
+
+    @classmethod
+    def calculators(cls) -> List[str]:
+        # Names of all calculators, without prefix
+        return sorted(name[len(cls._PREFIX) :] for name in dir(cls) if name.startswith(cls._PREFIX))
+
+    def cache_info(self) -> dict:
+        return self._cache.info()
+
+    def memory_usage(self) -> dict:
+        # Deep usage in bytes of the parsed frames and cached intermediates, costly for object columns
+        return {"detections": int(self._detections.memory_usage(deep=True).sum()), "cache": self._cache.nbytes}
+
+    def release(self):
+        # Drops all intermediate results, statistics can still be generated but will be computed again
+        self._cache.release()
 
     @classmethod
     def _group(cls, df: Union[pd.DataFrame, pd.Series]) -> Union[DataFrameGroupBy, SeriesGroupBy]:
         return df.groupby(cls._JOIN)
 
-    @lru_cache(10)
+    @cached
     def _survey_mask(self, survey: str) -> pd.Series:
         return self._detections["sid"].str.lower() == survey.lower()
 
-    @lru_cache(10)
+    @cached
     def _surveys_mask(self, surveys: Tuple[str] = None) -> pd.Series:
         if surveys is not None:
             return reduce(
@@ -39,28 +110,48 @@ class BaseStatistics(abc.ABC):
             )
         return pd.Series(True, index=self._detections.index)
 
-    @lru_cache(6)
-    def _select_detections(self, *, surveys: Tuple[str] = None, corrected: bool = False) -> pd.Series:
+    @cached
+    def _detections_mask(self, *, surveys: Tuple[str] = None, corrected: bool = False) -> pd.Series:
         mask = self._detections["corrected"] if corrected else pd.Series(True, index=self._detections.index)
-        return self._detections[self._surveys_mask(surveys) & mask]
+        return self._surveys_mask(surveys) & mask
 
-    @lru_cache(12)
-    def _grouped_index(
+    @cached
+    def _select_detections(self, *, surveys: Tuple[str] = None, corrected: bool = False) -> pd.DataFrame:
+        return self._detections[self._detections_mask(surveys=surveys, corrected=corrected)]
+
+    @cached
+    def _sort_order(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Positions that sort all detections by group and date (stable for ties) and the sorted group codes
+        codes = self._grouped_detections().ngroup().fillna(-1).to_numpy(dtype=np.int64)
+        order = np.lexsort((self._detections["mjd"].to_numpy(), codes))
+        return order, codes[order]
+
+    @cached
+    def _grouped_rows(
         self,
         *,
         which: Literal["first", "last"],
         surveys: Tuple[str] = None,
         corrected: bool = False,
-    ) -> pd.Series:
-        if which == "first":
-            function = "idxmin"
-        elif which == "last":
-            function = "idxmax"
-        else:
+    ) -> pd.DataFrame:
+        if which not in ("first", "last"):
             raise ValueError(f"Unrecognized value for 'which': {which}")
-        return self._grouped_detections(surveys=surveys, corrected=corrected)["mjd"].agg(function)
 
-    @lru_cache(36)
+        order, codes = self._sort_order()
+        # Any subset of the sorted detections is still sorted, rows without a group (code -1) are left out
+        selected = self._detections_mask(surveys=surveys, corrected=corrected).to_numpy()[order] & (codes >= 0)
+        positions, codes = order[selected], codes[selected]
+        mjd = self._detections["mjd"].to_numpy()[positions]
+
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+        if which == "first":
+            edges = starts
+        else:  # First row in original order among those sharing the last date, as with idxmax
+            runs = np.flatnonzero(np.diff(codes, prepend=-1) | (np.diff(mjd, prepend=np.nan) != 0))
+            run_start = np.repeat(runs, np.diff(runs, append=codes.size))
+            edges = run_start[np.r_[starts[1:], codes.size][: starts.size] - 1]
+        return self._detections.iloc[positions[edges]].set_index(self._JOIN)
+
     def _grouped_value(
         self,
         column: str,
@@ -69,25 +160,43 @@ class BaseStatistics(abc.ABC):
         surveys: Tuple[str] = None,
         corrected: bool = False,
     ) -> pd.Series:
-        idx = self._grouped_index(which=which, surveys=surveys, corrected=corrected)
-        df = self._select_detections(surveys=surveys, corrected=corrected)
-        return df[column][idx].set_axis(idx.index)
+        return self._grouped_rows(which=which, surveys=surveys, corrected=corrected)[column]
 
-    @lru_cache(6)
+    @cached
     def _grouped_detections(self, *, surveys: Tuple[str] = None, corrected: bool = False) -> DataFrameGroupBy:
-        return self._group(self._select_detections(surveys=surveys, corrected=corrected))
+        grouped = self._group(self._select_detections(surveys=surveys, corrected=corrected))
+        # Pandas builds the group codes and keys lazily on first use (cached on the grouper, shared by every column
+        # selection). Building them before the object is cached means that calculators in other threads only read them
+        grouper = grouped.grouper
+        grouper.group_info, grouper.result_index, grouper.ngroups, grouper.has_dropped_na, grouper.group_keys_seq
+        return grouped
 
+    @requires()
     def calculate_ndet(self) -> pd.DataFrame:
         return pd.DataFrame({"ndet": self._detections.value_counts(subset=self._JOIN, sort=False)})
 
-    def generate_statistics(self, exclude: Set[str] = None) -> pd.DataFrame:
-        exclude = exclude or set()  # Empty default
+    def _prepare(self):
+        # Intermediates shared by most calculators, computed before running the calculators concurrently
+        self._sort_order()
+
+    def _methods(self, exclude: Set[str] = None) -> List[str]:
+        exclude = set(exclude or ()) | getattr(self, "_exclude", set())
         # Add prefix to exclude, unless already provided
         exclude = {name if name.startswith(self._PREFIX) else f"{self._PREFIX}{name}" for name in exclude}
 
-        # Select all methods that start with prefix unless excluded
-        methods = {name for name in dir(self) if name.startswith(self._PREFIX) and name not in exclude}
+        # Select all methods that start with prefix unless excluded, sorted so that columns are always in same order
+        return sorted(name for name in dir(self) if name.startswith(self._PREFIX) and name not in exclude)
+
+    def submit_statistics(self, executor: Executor, exclude: Set[str] = None) -> Callable[[], pd.DataFrame]:
+        # Submits all calculators, the returned function waits for them and joins their results
+        self._prepare()
+        futures = [executor.submit(getattr(self, method)) for method in self._methods(exclude)]
+        return lambda: reduce(lambda left, right: left.join(right, how="outer"), [f.result() for f in futures])
+
+    def generate_statistics(self, exclude: Set[str] = None, executor: Executor = None) -> pd.DataFrame:
+        if executor is not None:
+            return self.submit_statistics(executor, exclude)()
 
         # Compute all statistics and join into single dataframe
-        stats = [getattr(self, method)() for method in methods]
+        stats = [getattr(self, method)() for method in self._methods(exclude)]
         return reduce(lambda left, right: left.join(right, how="outer"), stats)
@@ -0,0 +1,69 @@
+import functools
+import inspect
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+import numpy as np
+import pandas as pd
+
+
+class IntermediateCache:
+    # Holds intermediate results for a single batch. Nothing is evicted until the cache is released
+    def __init__(self):
+        self._entries: Dict[Hashable, Any] = {}
+        # One lock per key, so calculators only wait for the intermediates they need themselves
+        self._locks: Dict[Hashable, threading.Lock] = {}
+        self._guard = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(value: Any) -> int:
+        # Grouped objects only refer to frames that are already cached, so they add nothing
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return int(np.sum(value.memory_usage(deep=True)))
+        return 0
+
+    @property
+    def nbytes(self) -> int:
+        # Computed on demand, as deep memory usage is costly for object columns
+        return sum(self._sizeof(value) for value in self._entries.values())
+
+    def _lock(self, key: Hashable) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        if key not in self._entries:
+            # Calculators running concurrently compute each intermediate only once. Entries are only published once
+            # complete, so other threads never see a partially built one
+            with self._lock(key):
+                if key not in self._entries:
+                    value = compute()
+                    with self._guard:
+                        self.misses += 1
+                        self._entries[key] = value
+                    return value
+        self.hits += 1
+        return self._entries[key]
+
+    def info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "nbytes": self.nbytes}
+
+    def release(self):
+        self._entries.clear()
+        self._locks.clear()
+
+
+def cached(method: Callable) -> Callable:
+    # Key is the method name with all its arguments (including defaults), in signature order
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (method.__name__,) + tuple(bound.arguments.values())[1:]
+        return self._cache.get(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
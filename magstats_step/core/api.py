@@ -0,0 +1,79 @@
+from concurrent.futures import Executor
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Iterable, Set, Tuple
+
+import pandas as pd
+
+from ._base import BaseStatistics, Records
+from .healpix import sky_index
+from .magstats import MagnitudeStatistics
+from .objstats import ObjectStatistics
+
+
+def calculate_statistics(
+    detections: Records,
+    non_detections: Records = None,
+    *,
+    exclude: Set[str] = None,
+    windows: Iterable[float] = (),
+    healpix_orders: Iterable[int] = (),
+    executor: Executor = None,
+    timer: Callable[[str], ContextManager] = None,
+    on_release: Callable[[BaseStatistics], None] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Computes the object statistics and the magnitude statistics for each band.
+
+    Detections and non-detections can be data frames, Arrow tables or lists of records. Frames are used as given
+    and Arrow tables are converted avoiding copies where the column types allow it.
+
+    Parameters
+    ----------
+    detections
+        Detections with at least `aid`, `sid`, `fid`, `candid`, `mjd` and `forced`. Forced ones are ignored and only the
+        columns read by the calculators that are not excluded are kept
+    non_detections
+        Non-detections, only needed for the `dmdt` statistics
+    exclude
+        Names of calculators to skip, with or without the `calculate_` prefix
+    windows
+        Lengths in days of the windows for recent magnitude statistics, ending at the latest detection of each object
+    healpix_orders
+        Orders of the HEALPix (nested) sky index added for the mean coordinates
+    executor
+        Runs the calculators of both statistics concurrently if given
+    timer
+        Context manager factory that receives the name of each statistics class, to time them (no executor only)
+    on_release
+        Called with each calculator right before its intermediate results are released
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        Object statistics indexed by `aid` and magnitude statistics indexed by `aid`, `sid` and `fid`
+    """
+    timer = timer or (lambda name: nullcontext())
+    if executor is not None:
+        calculators = (
+            ObjectStatistics(detections, exclude=exclude),
+            MagnitudeStatistics(detections, non_detections, windows=windows, exclude=exclude),
+        )
+        # Both are submitted before waiting for any, so that all calculators share the pool
+        pending = [calculator.submit_statistics(executor) for calculator in calculators]
+        stats, magstats = [collect() for collect in pending]
+    else:
+        with timer(ObjectStatistics.__name__):
+            obj_calculator = ObjectStatistics(detections, exclude=exclude)
+            stats = obj_calculator.generate_statistics()
+        with timer(MagnitudeStatistics.__name__):
+            magstats_calculator = MagnitudeStatistics(detections, non_detections, windows=windows, exclude=exclude)
+            magstats = magstats_calculator.generate_statistics()
+        calculators = obj_calculator, magstats_calculator
+
+    for calculator in calculators:
+        if on_release:
+            on_release(calculator)
+        calculator.release()
+
+    if healpix_orders and "meanra" in stats:  # Coordinates can be excluded or deferred
+        stats = stats.join(sky_index(stats["meanra"], stats["meandec"], healpix_orders))
+    return stats, magstats
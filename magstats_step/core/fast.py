@@ -0,0 +1,301 @@
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+import numpy as np
+
+from .healpix import ang2pix_nested
+from .magstats import MagnitudeStatistics
+from .objstats import ObjectStatistics
+
+
+class _Groups:
+    # Rows sorted by group and date (stable for ties) as with BaseStatistics, rows without a key are left out
+    def __init__(self, keys: list, mjd: np.ndarray):
+        self.keys = sorted({key for key in keys if key is not None})
+        lookup = {key: code for code, key in enumerate(self.keys)}
+        codes = np.array([-1 if key is None else lookup[key] for key in keys], dtype=np.int64)
+        order = np.lexsort((mjd, codes))
+        self.order = order[codes[order] >= 0]
+        self.codes = codes
+        self.mjd = mjd
+        self.size = len(self.keys)
+
+    def segments(self, mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Sorted positions of the selected rows, their group codes and the start of each group among them
+        positions = self.order if mask is None else self.order[mask[self.order]]
+        codes = self.codes[positions]
+        return positions, codes, np.flatnonzero(np.diff(codes, prepend=-1))
+
+    def edges(self, mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Position of the first and last (first in input order among those sharing the last date) row of each group
+        positions, codes, starts = self.segments(mask)
+        mjd = self.mjd[positions]
+        runs = np.flatnonzero(np.diff(codes, prepend=-1) | (np.diff(mjd, prepend=np.nan) != 0))
+        run_start = np.repeat(runs, np.diff(runs, append=codes.size))
+        first, last = np.full(self.size, -1), np.full(self.size, -1)
+        first[codes[starts]] = positions[starts]
+        last[codes[starts]] = positions[run_start[np.r_[starts[1:], codes.size][: starts.size] - 1]]
+        return first, last
+
+    def aggregate(self, values: np.ndarray, mask: np.ndarray = None) -> Dict[str, np.ndarray]:
+        # Mean, median, max, min and standard deviation (ddof 0) skipping missing values, as pandas
+        positions, codes, starts = self.segments(mask)
+        stats = {name: np.full(self.size, np.nan) for name in ("mean", "median", "max", "min", "sigma")}
+        if not starts.size:
+            return stats
+        values = values[positions]
+        valid = ~np.isnan(values)
+        count = np.add.reduceat(valid, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.add.reduceat(np.where(valid, values, 0), starts) / count
+            deviation = np.where(valid, values - np.repeat(mean, np.diff(starts, append=codes.size)), 0)
+            sigma = np.sqrt(np.add.reduceat(deviation**2, starts) / count)
+        by_value = np.lexsort((values, codes))  # Missing values are sorted last within each group
+        low, high = by_value[starts + np.maximum(count - 1, 0) // 2], by_value[starts + count // 2]
+        median = np.where(count > 0, (values[low] + values[high]) / 2, np.nan)
+
+        group = codes[starts]
+        stats["mean"][group], stats["median"][group], stats["sigma"][group] = mean, median, sigma
+        stats["max"][group] = np.fmax.reduceat(values, starts)
+        stats["min"][group] = np.fmin.reduceat(values, starts)
+        return stats
+
+    def count(self, values: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+        # Sum of the values per group, missing for groups without selected rows
+        positions, codes, starts = self.segments(mask)
+        total = np.full(self.size, np.nan)
+        if starts.size:
+            total[codes[starts]] = np.add.reduceat(values[positions], starts)
+        return total
+
+    def unique(self, values: list) -> List[list]:
+        # Unique values of each group in order of first appearance
+        groups = [{} for _ in range(self.size)]
+        for code, value in zip(self.codes.tolist(), values):
+            if code >= 0:
+                groups[code].setdefault(value)
+        return [list(group) for group in groups]
+
+
+def _take(values: list, positions: np.ndarray) -> list:
+    return [values[p] if p >= 0 else None for p in positions.tolist()]
+
+
+def _native(value):
+    return None if isinstance(value, float) and value != value else value  # NaN is missing, as in the frames
+
+
+class _Columns:
+    # Columns of the records, parsed on first use
+    def __init__(self, records: List[dict]):
+        self.records = records
+        self._raw, self._numbers = {}, {}
+
+    def raw(self, name: str) -> list:
+        if name not in self._raw:
+            self._raw[name] = [record[name] for record in self.records]
+        return self._raw[name]
+
+    def numbers(self, name: str) -> np.ndarray:
+        if name not in self._numbers:
+            self._numbers[name] = np.array(self.raw(name), dtype=float)
+        return self._numbers[name]
+
+    def surveys(self, surveys: Iterable[str]) -> np.ndarray:
+        surveys = {survey.lower() for survey in surveys}
+        return np.array([isinstance(sid, str) and sid.lower() in surveys for sid in self.raw("sid")], dtype=bool)
+
+    def flags(self, name: str) -> np.ndarray:
+        return np.array(self.raw(name), dtype=bool)
+
+
+def _object_statistics(columns: _Columns, groups: _Groups, methods: Set[str]) -> Dict[str, list]:
+    stats = {}
+    first, last = groups.edges()
+    if "corrected" in methods:
+        ztf_first, _ = groups.edges(columns.surveys(ObjectStatistics._CORRECTED))
+        stats["corrected"] = _take(columns.raw("corrected"), ztf_first)
+    for label in ("dec", "ra"):
+        if label not in methods:
+            continue
+        weights = (columns.numbers(f"e_{label}") / 3600.0) ** -2
+        total = groups.count(weights)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats[f"mean{label}"] = (groups.count(columns.numbers(label) * weights) / total).tolist()
+            stats[f"sigma{label}"] = (np.sqrt(1 / total) * 3600.0).tolist()
+    if "firstmjd" in methods:
+        stats["firstmjd"] = _take(columns.raw("mjd"), first)
+    if "lastmjd" in methods:
+        stats["lastmjd"] = _take(columns.raw("mjd"), last)
+    if "ndet" in methods:
+        stats["ndet"] = np.bincount(groups.codes[groups.order], minlength=groups.size).tolist()
+    for label in ("oid", "sid", "stellar", "tid"):
+        if label not in methods:
+            continue
+        if label == "stellar":
+            ztf_first, _ = groups.edges(columns.surveys(ObjectStatistics._STELLAR))
+            stats["stellar"] = _take(columns.raw("stellar"), ztf_first)
+        else:
+            stats[label] = groups.unique(columns.raw(label))
+    # Keeps the order of the calculators in the frames
+    order = ["corrected", "meandec", "sigmadec", "firstmjd", "lastmjd", "ndet", "oid", "meanra", "sigmara", "sid"]
+    return {name: stats[name] for name in order + ["stellar", "tid"] if name in stats}
+
+
+def _dmdt(columns: _Columns, groups: _Groups, non_detections: List[dict]) -> Dict[str, list]:
+    dt_min = 0.5
+    first, _ = groups.edges()
+    mag, e_mag, mjd = (_take(columns.raw(name), first) for name in ("mag", "e_mag", "mjd"))
+    lookup = {key: code for code, key in enumerate(groups.keys)}
+
+    best = {}  # Code of the group to smallest dmdt and its values
+    seen = set()
+    for nd in non_detections:
+        key = (nd["oid"], nd["fid"], nd["mjd"])
+        if key in seen:
+            continue
+        seen.add(key)
+        code = lookup.get((nd["aid"], nd["sid"], nd["fid"]))
+        if code is None or None in (mag[code], e_mag[code], mjd[code], nd["mjd"], nd["diffmaglim"]):
+            continue
+        dt = mjd[code] - nd["mjd"]
+        dmdt = (mag[code] + e_mag[code] - nd["diffmaglim"]) / dt if dt else np.nan
+        if dt > dt_min and dmdt == dmdt and (code not in best or dmdt < best[code][3]):
+            best[code] = (dt, mag[code] - nd["diffmaglim"], e_mag[code] - nd["diffmaglim"], dmdt)
+
+    values = [best.get(code, (None,) * 4) for code in range(groups.size)]
+    return {f"{name}_first": [row[i] for row in values] for i, name in enumerate(("dt", "dm", "sigmadm", "dmdt"))}
+
+
+def _windowed(columns: _Columns, groups: _Groups, windows: Sequence[float]) -> Dict[str, list]:
+    positions, codes, starts = groups.segments()
+    if not starts.size:  # No detections left, e.g., only forced photometry
+        return {}
+    mjd, mag = columns.numbers("mjd")[positions], columns.numbers("mag")[positions]
+    ends = np.r_[starts[1:], codes.size].astype(np.int64)
+    # Windows end at the latest detection of the object in any band, as in MagnitudeStatistics
+    _, objects = np.unique([groups.keys[code][0] for code in codes[starts].tolist()], return_inverse=True)
+    latest = np.full(objects.max() + 1, np.nan)
+    np.fmax.at(latest, objects, np.fmax.reduceat(mjd, starts))
+    since = np.repeat(latest[objects], np.diff(np.r_[starts, codes.size])) - np.array(windows)[:, np.newaxis]
+    ndet = np.add.reduceat(mjd >= since, starts, axis=1)
+
+    valid = ~np.isnan(mag)
+    total = np.r_[0, np.cumsum(np.where(valid, mag, 0))]
+    count = np.r_[0, np.cumsum(valid)]
+    padded = np.r_[mag, np.nan]
+
+    stats = {}
+    for window, n in zip(windows, ndet):
+        lo = ends - n
+        bounds = np.column_stack([lo, ends]).ravel()
+        label = f"{window:g}d"
+        stats[f"ndet_{label}"] = n.tolist()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats[f"magmean_{label}"] = ((total[ends] - total[lo]) / (count[ends] - count[lo])).tolist()
+        stats[f"magmin_{label}"] = np.where(n > 0, np.fmin.reduceat(padded, bounds)[::2], np.nan).tolist()
+        stats[f"magmax_{label}"] = np.where(n > 0, np.fmax.reduceat(padded, bounds)[::2], np.nan).tolist()
+    return stats
+
+
+def _magnitude_statistics(
+    columns: _Columns, groups: _Groups, methods: Set[str], non_detections: List[dict], windows: Sequence[float]
+) -> Dict[str, list]:
+    stats = {}
+    first, last = groups.edges()
+    if "corrected" in methods:
+        stats["corrected"] = _take(columns.raw("corrected"), first)
+    if "dmdt" in methods:
+        stats.update(_dmdt(columns, groups, non_detections))
+    if "firstmjd" in methods:
+        stats["firstmjd"] = _take(columns.raw("mjd"), first)
+    if "lastmjd" in methods:
+        stats["lastmjd"] = _take(columns.raw("mjd"), last)
+    if "ndet" in methods:
+        stats["ndet"] = np.bincount(groups.codes[groups.order], minlength=groups.size).tolist()
+    if "ndubious" in methods:
+        stats["ndubious"] = groups.count(columns.flags("dubious")).astype(np.int64).tolist()
+    if "saturation_rate" in methods:
+        total = groups.count(columns.flags("corrected"))
+        saturated = np.full(groups.size, np.nan)
+        for survey, threshold in MagnitudeStatistics._THRESHOLD.items():
+            sat = groups.count(columns.numbers("mag_corr") < threshold, columns.surveys((survey,)))
+            saturated = np.where(np.isnan(sat), saturated, sat)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats["saturation_rate"] = np.where(total != 0, saturated / total, np.nan).tolist()
+    if "statistics" in methods:
+        for suffix, mask in (("", None), ("_corr", columns.flags("corrected"))):
+            aggregated = groups.aggregate(columns.numbers(f"mag{suffix}"), mask)
+            stats.update({f"mag{name}{suffix}": values.tolist() for name, values in aggregated.items()})
+            mag_first, mag_last = groups.edges(mask)
+            stats[f"magfirst{suffix}"] = _take(columns.raw(f"mag{suffix}"), mag_first)
+            stats[f"maglast{suffix}"] = _take(columns.raw(f"mag{suffix}"), mag_last)
+    if "stellar" in methods:
+        stats["stellar"] = _take(columns.raw("stellar"), first)
+    if "windowed" in methods and windows:
+        stats.update(_windowed(columns, groups, windows))
+    return stats
+
+
+def calculate_records(
+    detections: List[dict],
+    non_detections: List[dict] = None,
+    *,
+    exclude: Set[str] = None,
+    windows: Sequence[float] = (),
+    healpix_orders: Iterable[int] = (),
+) -> Dict[str, dict]:
+    """Computes the same statistics as `calculate_statistics`, already assembled as one dictionary per object.
+
+    Works on plain NumPy arrays instead of frames, which is faster for small batches of records.
+
+    Parameters
+    ----------
+    detections
+        Detections as records, see `calculate_statistics`
+    non_detections
+        Non-detections as records, only needed for the `dmdt` statistics
+    exclude
+        Names of calculators to skip, with or without the `calculate_` prefix
+    windows
+        Lengths in days of the windows for recent magnitude statistics
+    healpix_orders
+        Orders of the HEALPix (nested) sky index added for the mean coordinates
+
+    Returns
+    -------
+    dict[str, dict]
+        Object statistics for each `aid`, with the statistics of each band as a list under `magstats`
+    """
+    exclude = {name.removeprefix("calculate_") for name in exclude or ()}
+    candids, rows = set(), []
+    for detection in detections:
+        if not detection["forced"] and detection["candid"] not in candids:
+            candids.add(detection["candid"])
+            rows.append(detection)
+    columns = _Columns(rows)
+    mjd = columns.numbers("mjd")
+
+    objects = _Groups(columns.raw("aid"), mjd)
+    keys = [None if None in key else key for key in zip(columns.raw("aid"), columns.raw("sid"), columns.raw("fid"))]
+    bands = _Groups(keys, mjd)
+
+    stats = _object_statistics(columns, objects, set(ObjectStatistics.calculators()) - exclude)
+    if healpix_orders and "meanra" in stats:
+        ra, dec = np.array(stats["meanra"], dtype=float), np.array(stats["meandec"], dtype=float)
+        finite = np.isfinite(ra) & np.isfinite(dec)
+        for order in healpix_orders:
+            pixels = np.zeros(ra.size, dtype=np.int64)
+            pixels[finite] = ang2pix_nested(order, ra[finite], dec[finite])
+            stats[f"healpix_{order}"] = [int(p) if f else None for p, f in zip(pixels.tolist(), finite.tolist())]
+    magstats = _magnitude_statistics(
+        columns, bands, set(MagnitudeStatistics.calculators()) - exclude, non_detections or [], windows
+    )
+
+    result = {}
+    for code, aid in enumerate(objects.keys):
+        result[aid] = {name: _native(values[code]) for name, values in stats.items()}
+        result[aid]["magstats"] = []
+    for code, (aid, sid, fid) in enumerate(bands.keys):
+        record = {"sid": sid, "fid": fid} | {name: _native(values[code]) for name, values in magstats.items()}
+        result[aid]["magstats"].append(record)
+    return result
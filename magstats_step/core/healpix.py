@@ -0,0 +1,56 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+
+def _interleave(ix: np.ndarray, iy: np.ndarray, order: int) -> np.ndarray:
+    # Bits of x go to the even positions of the nested index and bits of y to the odd ones
+    index = np.zeros_like(ix)
+    for bit in range(order):
+        index |= ((ix >> bit) & 1) << (2 * bit) | ((iy >> bit) & 1) << (2 * bit + 1)
+    return index
+
+
+def ang2pix_nested(order: int, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    # HEALPix pixels in the nested scheme for nside = 2 ** order (up to order 29), coordinates in degrees
+    nside = 1 << order
+    z = np.sin(np.radians(np.atleast_1d(dec).astype(float)))
+    tt = np.mod(np.atleast_1d(ra).astype(float), 360) / 90  # In [0, 4)
+    za = np.abs(z)
+    face, ix, iy = np.empty((3, z.size), dtype=np.int64)
+
+    equatorial = za <= 2 / 3
+    zq, tq = z[equatorial], tt[equatorial]
+    jp = (nside * (0.5 + tq - 0.75 * zq)).astype(np.int64)  # Index of ascending edge line
+    jm = (nside * (0.5 + tq + 0.75 * zq)).astype(np.int64)  # Index of descending edge line
+    ifp, ifm = jp >> order, jm >> order
+    face[equatorial] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[equatorial] = jm & (nside - 1)
+    iy[equatorial] = nside - (jp & (nside - 1)) - 1
+
+    polar = ~equatorial
+    zq, tq = z[polar], tt[polar]
+    ntt = np.minimum(tq.astype(np.int64), 3)
+    tp = tq - ntt
+    tmp = nside * np.sqrt(3 * (1 - np.abs(zq)))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = zq >= 0
+    face[polar] = np.where(north, ntt, ntt + 8)
+    ix[polar] = np.where(north, nside - jm - 1, jp)
+    iy[polar] = np.where(north, nside - jp - 1, jm)
+
+    return (face << (2 * order)) + _interleave(ix, iy, order)
+
+
+def sky_index(ra: pd.Series, dec: pd.Series, orders: Iterable[int]) -> pd.DataFrame:
+    # One column of nested pixels per order, missing for objects without finite coordinates
+    finite = np.isfinite(ra.to_numpy(dtype=float)) & np.isfinite(dec.to_numpy(dtype=float))
+    columns = {}
+    for order in orders:
+        pixels = pd.array(np.zeros(finite.size, dtype=np.int64), dtype="Int64")
+        pixels[~finite] = pd.NA
+        pixels[finite] = ang2pix_nested(order, ra[finite], dec[finite])
+        columns[f"healpix_{order}"] = pixels
+    return pd.DataFrame(columns, index=ra.index)
@@ -1,9 +1,9 @@
-from typing import List
+from typing import Sequence, Set
 
 import numpy as np
 import pandas as pd
 
-from ._base import BaseStatistics
+from ._base import BaseStatistics, Records, requires
 
 
 class MagnitudeStatistics(BaseStatistics):
@@ -11,13 +11,25 @@ class MagnitudeStatistics(BaseStatistics):
     # Saturation threshold for each survey (only applies to corrected magnitudes)
     _THRESHOLD = {"ZTF": 13.2}
 
-    def __init__(self, detections: List[dict], non_detections: List[dict] = None):
-        super().__init__(detections)
-        if non_detections:
-            self._non_detections = pd.DataFrame.from_records(non_detections).drop_duplicates(["oid", "fid", "mjd"])
+    def __init__(
+        self,
+        detections: Records,
+        non_detections: Records = None,
+        windows: Sequence[float] = (),
+        exclude: Set[str] = None,
+    ):
+        super().__init__(detections, exclude=exclude)
+        # Lengths in days of the windows for recent statistics, counted back from the last detection of each group
+        self._windows = tuple(windows)
+        if non_detections is not None and len(non_detections):
+            self._non_detections = self._as_frame(non_detections).drop_duplicates(["oid", "fid", "mjd"])
         else:
             self._non_detections = pd.DataFrame()
 
+    def memory_usage(self) -> dict:
+        usage = super().memory_usage()
+        return usage | {"non_detections": int(self._non_detections.memory_usage(deep=True).sum())}
+
     def _calculate_stats(self, corrected: bool = False) -> pd.DataFrame:
         suffix = "_corr" if corrected else ""
         in_label, out_label = f"mag{suffix}", f"mag{{}}{suffix}"
@@ -41,27 +53,71 @@ class MagnitudeStatistics(BaseStatistics):
         last = self._grouped_value(in_label, which="last", corrected=corrected)
         return pd.DataFrame({out_label.format("first"): first, out_label.format("last"): last})
 
+    @requires("mag", "mag_corr", "corrected")
     def calculate_statistics(self) -> pd.DataFrame:
         stats = self._calculate_stats(corrected=False)
         stats = stats.join(self._calculate_stats_over_time(corrected=False), how="outer")
         stats = stats.join(self._calculate_stats(corrected=True), how="outer")
         return stats.join(self._calculate_stats_over_time(corrected=True), how="outer")
 
+    @requires("mag")
+    def calculate_windowed(self) -> pd.DataFrame:
+        order, codes = self._sort_order()
+        positions, codes = order[codes >= 0], codes[codes >= 0]
+        if not self._windows or not codes.size:  # No detections left, e.g., only forced photometry
+            return pd.DataFrame(index=self._grouped_detections().size().index)
+        mjd = self._detections["mjd"].to_numpy(dtype=float)[positions]
+        mag = self._detections["mag"].to_numpy(dtype=float)[positions]
+
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+        ends = np.r_[starts[1:], codes.size].astype(np.int64)
+        index = pd.MultiIndex.from_frame(self._detections.iloc[positions[starts]][self._JOIN])
+
+        # Windows end at the latest detection of the object in any band, so stale bands have nothing in them
+        latest = pd.Series(np.fmax.reduceat(mjd, starts), index=index).groupby(level="aid").transform("max").to_numpy()
+        # Dates are sorted within each group, so every window is the tail of its group: all windows in one pass
+        since = np.repeat(latest, np.diff(np.r_[starts, codes.size])) - np.array(self._windows)[:, np.newaxis]
+        ndet = np.add.reduceat(mjd >= since, starts, axis=1)
+
+        valid = ~np.isnan(mag)
+        total = np.r_[0, np.cumsum(np.where(valid, mag, 0))]
+        count = np.r_[0, np.cumsum(valid)]
+        padded = np.r_[mag, np.nan]  # Segment ends can be one past the last row
+
+        stats = {}
+        for window, n in zip(self._windows, ndet):
+            lo = ends - n
+            bounds = np.column_stack([lo, ends]).ravel()
+            label = f"{window:g}d"
+            stats[f"ndet_{label}"] = n
+            with np.errstate(invalid="ignore"):
+                stats[f"magmean_{label}"] = (total[ends] - total[lo]) / (count[ends] - count[lo])
+            # Empty windows would take the first value of the next group
+            stats[f"magmin_{label}"] = np.where(n > 0, np.fmin.reduceat(padded, bounds)[::2], np.nan)
+            stats[f"magmax_{label}"] = np.where(n > 0, np.fmax.reduceat(padded, bounds)[::2], np.nan)
+        return pd.DataFrame(stats, index=index)
+
+    @requires()
     def calculate_firstmjd(self) -> pd.DataFrame:
         return pd.DataFrame({"firstmjd": self._grouped_value("mjd", which="first")})
 
+    @requires()
     def calculate_lastmjd(self) -> pd.DataFrame:
         return pd.DataFrame({"lastmjd": self._grouped_value("mjd", which="last")})
 
+    @requires("corrected")
     def calculate_corrected(self) -> pd.DataFrame:
         return pd.DataFrame({"corrected": self._grouped_value("corrected", which="first")})
 
+    @requires("stellar")
     def calculate_stellar(self) -> pd.DataFrame:
         return pd.DataFrame({"stellar": self._grouped_value("stellar", which="first")})
 
+    @requires("dubious")
     def calculate_ndubious(self) -> pd.DataFrame:
         return pd.DataFrame({"ndubious": self._grouped_detections()["dubious"].sum()})
 
+    @requires("mag_corr", "corrected")
     def calculate_saturation_rate(self) -> pd.DataFrame:
         total = self._grouped_detections()["corrected"].sum()
         saturated = pd.Series(index=total.index, dtype=float)
@@ -72,6 +128,7 @@ class MagnitudeStatistics(BaseStatistics):
         rate = np.where(total.ne(0), saturated.astype(float) / total, np.nan)
         return pd.DataFrame({"saturation_rate": rate}, index=total.index)
 
+    @requires("mag", "e_mag")
     def calculate_dmdt(self) -> pd.DataFrame:
         dt_min = 0.5
 
@@ -1,16 +1,17 @@
-from typing import Union, Literal, List
+from typing import Union, Literal, Set, Tuple
 
 import numpy as np
 import pandas as pd
 
-from ._base import BaseStatistics
+from ._base import BaseStatistics, Records, requires
+from ._cache import cached
 
 
 class ObjectStatistics(BaseStatistics):
     _JOIN = "aid"
 
-    def __init__(self, detections: List[dict]):
-        super().__init__(detections)
+    def __init__(self, detections: Records, exclude: Set[str] = None):
+        super().__init__(detections, exclude=exclude)
 
     @staticmethod
     def _arcsec2deg(values: Union[pd.Series, float]) -> Union[pd.Series, float]:
@@ -45,32 +46,58 @@ class ObjectStatistics(BaseStatistics):
             }
         )
 
-    def _calculate_unique(self, label: str) -> pd.DataFrame:
-        return pd.DataFrame({label: self._grouped_detections()[label].unique().apply(list)})
+    def _prepare(self):
+        super()._prepare()
+        self._factorized_join()
+
+    @cached
+    def _factorized_join(self) -> Tuple[np.ndarray, pd.Index]:
+        codes, uniques = pd.factorize(self._detections[self._JOIN], sort=True)
+        return codes, pd.Index(uniques, name=self._JOIN)
 
+    def _calculate_unique(self, label: str) -> pd.DataFrame:
+        codes, index = self._factorized_join()
+        # Unique pairs keep their first appearance, stable sort by group keeps that order within each group
+        pairs = pd.DataFrame({"code": codes, label: self._detections[label].to_numpy()}).drop_duplicates()
+        pairs = pairs[pairs["code"] >= 0]  # Code is -1 for missing keys, which groupby would also drop
+        order = np.argsort(pairs["code"].to_numpy(), kind="stable")
+        values = pairs[label].to_numpy()[order].tolist()
+        ends = np.cumsum(np.bincount(pairs["code"].to_numpy(), minlength=index.size)).tolist()
+        lists = [values[start:end] for start, end in zip([0] + ends[:-1], ends)]
+        return pd.DataFrame({label: pd.Series(lists, index=index, dtype=object)})
+
+    @requires("ra", "e_ra")
     def calculate_ra(self) -> pd.DataFrame:
         return self._calculate_coordinates("ra")
 
+    @requires("dec", "e_dec")
     def calculate_dec(self) -> pd.DataFrame:
         return self._calculate_coordinates("dec")
 
+    @requires()
     def calculate_firstmjd(self) -> pd.DataFrame:
         return pd.DataFrame({"firstmjd": self._grouped_value("mjd", which="first")})
 
+    @requires()
     def calculate_lastmjd(self) -> pd.DataFrame:
         return pd.DataFrame({"lastmjd": self._grouped_value("mjd", which="last")})
 
+    @requires("oid")
     def calculate_oid(self) -> pd.DataFrame:
         return self._calculate_unique("oid")
 
+    @requires("tid")
     def calculate_tid(self) -> pd.DataFrame:
         return self._calculate_unique("tid")
 
+    @requires("sid")
     def calculate_sid(self) -> pd.DataFrame:
         return self._calculate_unique("sid")
 
+    @requires("corrected")
     def calculate_corrected(self) -> pd.DataFrame:
         return pd.DataFrame({"corrected": self._grouped_value("corrected", which="first", surveys=self._CORRECTED)})
 
+    @requires("stellar")
     def calculate_stellar(self) -> pd.DataFrame:
         return pd.DataFrame({"stellar": self._grouped_value("stellar", which="first", surveys=self._STELLAR)})
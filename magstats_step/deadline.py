@@ -0,0 +1,33 @@
+from typing import Iterable, Set
+
+
+class DeadlinePlanner:
+    # Seconds per row of each calculator, measured on synthetic batches. Rows are non-detections for those in
+    # _NON_DETECTION_ROWS and detections for the rest
+    COSTS = {"ra": 3.3e-5, "dec": 3.3e-5, "dmdt": 2.2e-5, "saturation_rate": 8e-6, "statistics": 3e-6}
+    DEFAULT_COST = 5e-7
+    _NON_DETECTION_ROWS = {"dmdt"}
+
+    def __init__(self, config: dict):
+        self.budget = config["BUDGET"]  # Seconds per batch
+        self.expensive = set(config.get("EXPENSIVE", ["ra", "dec"]))
+        self.costs = self.COSTS | config.get("COSTS", {})
+        # Objects with deferred statistics kept at most, beyond that they are computed regardless of the deadline
+        self.max_deferred = config.get("MAX_DEFERRED", 100000)
+        # Maximum number of rows computed at once by the catch-up path
+        self.catch_up_rows = config.get("CATCH_UP_ROWS", 10000)
+        # Batches whose commit can be held back for deferred statistics, after that everything is caught up at once
+        self.max_held_batches = config.get("MAX_HELD_BATCHES", 100)
+
+    def estimate(self, calculators: Iterable[str], detections: int, non_detections: int) -> float:
+        return sum(
+            self.costs.get(name, self.DEFAULT_COST)
+            * (non_detections if name in self._NON_DETECTION_ROWS else detections)
+            for name in calculators
+        )
+
+    def plan(self, calculators: Set[str], detections: int, non_detections: int) -> Set[str]:
+        # Calculators to defer, only when the batch is expected to exceed its budget
+        if self.estimate(calculators, detections, non_detections) <= self.budget:
+            return set()
+        return self.expensive & calculators
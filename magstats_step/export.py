@@ -0,0 +1,135 @@
+import datetime
+import logging
+import os
+import time
+from typing import Dict, Tuple
+
+import pandas as pd
+
+
+class ColumnarSink:
+    # Appends the statistics of each batch to columnar files partitioned by date and aid prefix:
+    # <PATH>/<table>/date=<YYYY-MM-DD>/prefix=<aid prefix>/part-*.<format>
+    _FORMATS = ("parquet", "arrow")
+
+    def __init__(self, config: dict):
+        # pyarrow is an optional dependency, only required when the sink is enabled
+        import pyarrow
+
+        self._pa = pyarrow
+        self.path = config["PATH"]
+        self.format = config.get("FORMAT", "parquet")
+        if self.format not in self._FORMATS:
+            raise ValueError(f"Unrecognized columnar format: {self.format}")
+        self.prefix_length = config.get("AID_PREFIX_LENGTH", 4)
+        # A file is closed and a new one started once it holds this many rows
+        self.rollover_rows = config.get("ROLLOVER_ROWS", 1000000)
+        # Closed files with fewer rows than the rollover are merged once a partition has this many of them
+        self.compact_files = config.get("COMPACT_FILES", 8)
+        self.logger = logging.getLogger(f"alerce.{self.__class__.__name__}")
+        # Open writer for each (table, date, prefix), with its final path, schema and number of rows written
+        self._writers: Dict[Tuple[str, str, str], list] = {}
+        self.date = None  # Date of the partitions being written
+
+    def _partition(self, table: str, date: str, prefix: str) -> str:
+        return os.path.join(self.path, table, f"date={date}", f"prefix={prefix}")
+
+    def _new_file(self, directory: str) -> str:
+        return os.path.join(directory, f"part-{time.time_ns()}.{self.format}")
+
+    @staticmethod
+    def _in_progress(path: str) -> str:
+        # Files starting with underscore are ignored when reading the directory as a dataset
+        directory, name = os.path.split(path)
+        return os.path.join(directory, f"_{name}")
+
+    def _open(self, path: str, schema):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.format == "parquet":
+            import pyarrow.parquet
+
+            return pyarrow.parquet.ParquetWriter(self._in_progress(path), schema)
+        return self._pa.ipc.new_file(self._in_progress(path), schema)
+
+    def _read(self, path: str):
+        if self.format == "parquet":
+            import pyarrow.parquet
+
+            return pyarrow.parquet.read_table(path)
+        return self._pa.ipc.open_file(self._pa.memory_map(path)).read_all()
+
+    def _num_rows(self, path: str) -> int:
+        if self.format == "parquet":
+            import pyarrow.parquet
+
+            return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+        return self._read(path).num_rows  # Memory mapped, so only the metadata is actually read
+
+    def _close(self, key: Tuple[str, str, str]):
+        writer, path, _, _ = self._writers.pop(key)
+        writer.close()
+        os.rename(self._in_progress(path), path)
+
+    def _append(self, table: str, date: str, frame: pd.DataFrame):
+        frame = frame.reset_index()
+        for prefix, part in frame.groupby(frame["aid"].str[: self.prefix_length], sort=False):
+            data = self._pa.Table.from_pandas(part, preserve_index=False)
+            key = (table, date, prefix)
+            if key in self._writers and not self._writers[key][2].equals(data.schema):
+                self._close(key)  # Columns can change between batches (e.g., deferred calculators)
+            if key not in self._writers:
+                path = self._new_file(self._partition(*key))
+                self._writers[key] = [self._open(path, data.schema), path, data.schema, 0]
+            self._writers[key][0].write_table(data)
+            self._writers[key][3] += data.num_rows
+            if self._writers[key][3] >= self.rollover_rows:
+                self._close(key)
+
+    def write(self, stats: pd.DataFrame, magstats: pd.DataFrame):
+        date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+        if self.date is not None and date != self.date:  # Nothing else is written to the previous date
+            self.close()
+            self.compact(self.date)
+        self.date = date
+        self._append("object", date, stats)
+        self._append("magstats", date, magstats)
+
+    def close(self):
+        for key in list(self._writers):
+            self._close(key)
+
+    def compact(self, date: str = None):
+        # Merges small closed files within each partition of the given date (all dates by default)
+        for table in ("object", "magstats"):
+            table_path = os.path.join(self.path, table)
+            if not os.path.isdir(table_path):
+                continue
+            dates = [f"date={date}"] if date else os.listdir(table_path)
+            for date_dir in dates:
+                date_path = os.path.join(self.path, table, date_dir)
+                for prefix_dir in os.listdir(date_path) if os.path.isdir(date_path) else []:
+                    self._compact_partition(os.path.join(date_path, prefix_dir))
+
+    def _compact_partition(self, directory: str):
+        open_paths = {path for _, path, _, _ in self._writers.values()}
+        small = [
+            os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if not name.startswith("_") and os.path.join(directory, name) not in open_paths
+        ]
+        small = [path for path in small if self._num_rows(path) < self.rollover_rows]
+        if len(small) < self.compact_files:
+            return
+        try:
+            merged = self._pa.concat_tables([self._read(path) for path in small], promote_options="default")
+        except self._pa.ArrowInvalid as error:  # Incompatible types across files, left as they are
+            self.logger.warning(f"Cannot compact {directory}: {error}")
+            return
+        path = self._new_file(directory)
+        writer = self._open(path, merged.schema)
+        writer.write_table(merged)
+        writer.close()
+        os.rename(self._in_progress(path), path)
+        for old in small:
+            os.remove(old)
+        self.logger.info(f"Compacted {len(small)} files into {path}")
@@ -0,0 +1,71 @@
+import time
+from typing import List
+
+import numpy as np
+from apf.consumers import GenericConsumer
+from apf.producers import GenericProducer
+
+from magstats_step.synthetic import generate_messages
+
+
+class InMemoryConsumer(GenericConsumer):
+    # Serves synthetic messages in batches, recording how long the step takes from each batch until its commit
+    def __init__(self, config: dict = None):
+        super().__init__(config)
+        config = config or {}
+        self.batch_size = config.get("BATCH_SIZE", 100)
+        # Generated up front, so that it does not count towards the time spent by the step
+        self.messages = generate_messages(
+            config.get("N_MESSAGES", 1000),
+            n_detections=config.get("N_DETECTIONS", 10),
+            n_non_detections=config.get("N_NON_DETECTIONS", 5),
+            seed=config.get("SEED", 0),
+        )
+        self.latencies: List[float] = []
+        self.committed = 0
+        self._consumed = None
+        self._batch = []
+
+    def consume(self):
+        for start in range(0, len(self.messages), self.batch_size):
+            self._batch = self.messages[start : start + self.batch_size]
+            self._consumed = time.perf_counter()
+            yield self._batch
+
+    def commit(self):
+        self.latencies.append(time.perf_counter() - self._consumed)
+        self.committed += len(self._batch)
+
+    def report(self, elapsed: float) -> dict:
+        detections = sum(len(msg["detections"]) for msg in self.messages[: self.committed])
+        p50, p99 = np.percentile(self.latencies, [50, 99]) if self.latencies else (np.nan, np.nan)
+        return {
+            "messages": self.committed,
+            "batches": len(self.latencies),
+            "messages_per_second": self.committed / elapsed,
+            "detections_per_second": detections / elapsed,
+            "p50_batch_latency": p50,
+            "p99_batch_latency": p99,
+        }
+
+
+class InMemoryProducer(GenericProducer):
+    # Keeps produced messages in memory. With KEEP_MESSAGES disabled only the count is kept
+    def __init__(self, config: dict = None):
+        super().__init__(config)
+        self.keep = (config or {}).get("KEEP_MESSAGES", True)
+        self.messages = []
+        self.produced = 0
+
+    def produce(self, message=None, **kwargs):
+        self.produced += 1
+        if self.keep:
+            self.messages.append(message)
+        if "on_delivery" in kwargs:  # Delivered right away, as a broker without any latency would
+            kwargs["on_delivery"](None, message)
+
+    def poll(self, timeout: float = 0):
+        pass
+
+    def flush(self):
+        pass
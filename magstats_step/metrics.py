@@ -0,0 +1,118 @@
+import time
+from contextlib import contextmanager
+
+
+class StageMetrics:
+    # Does not record anything, used when prometheus metrics are disabled
+    @contextmanager
+    def time_stage(self, stage: str):
+        yield
+
+    @contextmanager
+    def time_calculator(self, calculator: str):
+        yield
+
+    def observe_batch(self, *, messages: int, detections: int, non_detections: int, aids: int):
+        pass
+
+    def observe_delivery(self, latency: float, *, failed: bool = False):
+        pass
+
+    def set_in_flight(self, in_flight: int):
+        pass
+
+    def count_retry(self):
+        pass
+
+    def observe_memory(self, kind: str, nbytes: int):
+        pass
+
+
+class PrometheusStageMetrics(StageMetrics):
+    _SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+    def __init__(self, registry=None):
+        # prometheus-client is an optional dependency, only required when the metrics are enabled
+        from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+        self.registry = registry or CollectorRegistry()
+        self.stage_duration = Histogram(
+            "magstats_stage_duration_seconds",
+            "Duration of each stage of the step",
+            ["stage"],
+            registry=self.registry,
+        )
+        self.calculator_duration = Histogram(
+            "magstats_calculator_duration_seconds",
+            "Duration of the statistics generation for each calculator",
+            ["calculator"],
+            registry=self.registry,
+        )
+        self.batch_size = Histogram(
+            "magstats_batch_size",
+            "Number of elements of each kind in a batch",
+            ["kind"],
+            buckets=self._SIZE_BUCKETS,
+            registry=self.registry,
+        )
+        self.delivery_latency = Histogram(
+            "magstats_scribe_delivery_seconds",
+            "Time from producing a scribe message until its delivery report",
+            ["status"],
+            registry=self.registry,
+        )
+        self.in_flight = Gauge(
+            "magstats_scribe_in_flight",
+            "Scribe messages produced and awaiting a delivery report",
+            registry=self.registry,
+        )
+        self.retries = Counter(
+            "magstats_scribe_retries",
+            "Scribe produce attempts retried because the local queue was full",
+            registry=self.registry,
+        )
+        self.memory = Gauge(
+            "magstats_memory_bytes",
+            "Memory used by each kind of data in the last batch (only with memory profiling)",
+            ["kind"],
+            registry=self.registry,
+        )
+
+    def serve(self, port: int):
+        from prometheus_client import start_http_server
+
+        start_http_server(port, registry=self.registry)
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_duration.labels(stage).observe(time.perf_counter() - start)
+
+    @contextmanager
+    def time_calculator(self, calculator: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.calculator_duration.labels(calculator).observe(time.perf_counter() - start)
+
+    def observe_batch(self, *, messages: int, detections: int, non_detections: int, aids: int):
+        self.batch_size.labels("messages").observe(messages)
+        self.batch_size.labels("detections").observe(detections)
+        self.batch_size.labels("non_detections").observe(non_detections)
+        self.batch_size.labels("aids").observe(aids)
+
+    def observe_delivery(self, latency: float, *, failed: bool = False):
+        self.delivery_latency.labels("failed" if failed else "delivered").observe(latency)
+
+    def set_in_flight(self, in_flight: int):
+        self.in_flight.set(in_flight)
+
+    def count_retry(self):
+        self.retries.inc()
+
+    def observe_memory(self, kind: str, nbytes: int):
+        self.memory.labels(kind).set(nbytes)
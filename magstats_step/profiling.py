@@ -0,0 +1,144 @@
+import collections
+import logging
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from types import FrameType
+
+from magstats_step.core._base import BaseStatistics
+from magstats_step.metrics import StageMetrics
+
+
+class MemoryProfiler:
+    # Reports memory used per batch. Allocations are only traced on sampled batches, as tracing slows everything down
+    def __init__(self, config: dict, metrics: StageMetrics = None):
+        self.sample_every = config.get("TRACEMALLOC_EVERY", 100)  # Zero disables tracing allocations
+        self.top = config.get("TOP", 10)
+        self.metrics = metrics or StageMetrics()
+        self.logger = logging.getLogger(f"alerce.{self.__class__.__name__}")
+        self.batches = 0
+        self.usage = {}
+
+    @property
+    def sampled(self) -> bool:
+        return self.sample_every > 0 and self.batches % self.sample_every == 0
+
+    @staticmethod
+    def reset_rss_high_water():
+        # Resets the peak RSS of the process (Linux), so that the next reading only covers the current batch
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+    @staticmethod
+    def rss_high_water() -> int:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024  # Reported in kilobytes
+        except OSError:
+            pass
+        # Without procfs, only the peak over the whole lifetime of the process is available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Reported in kilobytes on Linux
+
+    def start_batch(self):
+        self.usage = {}
+        self.reset_rss_high_water()
+        if self.sampled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def observe_calculator(self, calculator: BaseStatistics):
+        # Chunks of a batch are computed one at a time, so the largest of them is kept
+        name = type(calculator).__name__
+        for kind, nbytes in calculator.memory_usage().items():
+            key = f"{name}.{kind}"
+            self.usage[key] = max(self.usage.get(key, 0), nbytes)
+
+    def end_batch(self) -> dict:
+        self.usage["rss_high_water"] = self.rss_high_water()
+        for kind, nbytes in self.usage.items():
+            self.metrics.observe_memory(kind, nbytes)
+        self.logger.info(f"Memory usage (bytes): {self.usage}")
+
+        if self.sampled and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            for stat in snapshot.statistics("lineno")[: self.top]:
+                self.logger.info(f"Top allocation: {stat}")
+        self.batches += 1
+        return self.usage
+
+
+class SamplingProfiler:
+    # Samples the stacks of the step for a fixed duration and writes them in collapsed format (flamegraph ready),
+    # with the stage or calculator being run as root of each stack
+    _STAGES = {
+        "_pre_execute": "pre_execute",
+        "execute": "execute",
+        "assemble": "assemble",
+        "produce_scribe": "produce_scribe",
+        "catch_up": "catch_up",
+        "post_execute": "post_execute",
+    }
+
+    def __init__(self, config: dict):
+        self.path = config.get("PATH", "profiles")
+        self.duration = config.get("DURATION", 30)
+        self.interval = config.get("INTERVAL", 0.005)
+        self.thread_id = threading.get_ident()  # Thread running the step, calculator threads are sampled as well
+        self.logger = logging.getLogger(f"alerce.{self.__class__.__name__}")
+        self._thread = None
+        if config.get("SIGNAL"):
+            signal.signal(getattr(signal, config["SIGNAL"]), lambda *_: self.start())
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    @classmethod
+    def collapse(cls, frame: FrameType) -> str:
+        frames, tag = [], None
+        while frame is not None:  # From innermost to outermost, the innermost stage gives the tag
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            if tag is None and code.co_name.startswith("calculate_"):
+                calculator = frame.f_locals.get("self")
+                if isinstance(calculator, BaseStatistics):
+                    tag = f"{type(calculator).__name__}.{code.co_name}"
+            if tag is None and code.co_name in cls._STAGES:
+                tag = cls._STAGES[code.co_name]
+            frame = frame.f_back
+        return ";".join([tag or "other"] + frames[::-1])
+
+    def _run(self):
+        counts = collections.Counter()
+        end = time.monotonic() + self.duration
+        while time.monotonic() < end:
+            targets = {self.thread_id} | {t.ident for t in threading.enumerate() if t.name.startswith("calculator")}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in targets:
+                    counts[self.collapse(frame)] += 1
+            time.sleep(self.interval)
+
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, f"profile-{os.getpid()}-{int(time.time())}.collapsed")
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in counts.most_common())
+        self.logger.info(f"Wrote {sum(counts.values())} samples to {path}")
@@ -0,0 +1,5 @@
+from ._base import ObjectReader
+from .memory import InMemoryObjectReader
+from .mongo import MongoObjectReader
+
+__all__ = ["ObjectReader", "InMemoryObjectReader", "MongoObjectReader"]
@@ -0,0 +1,55 @@
+import abc
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+
+class ObjectReader(abc.ABC):
+    # Read-through cache of previous object documents, with entries evicted in least recently used order
+    def __init__(self, config: dict):
+        self.cache_size = config.get("CACHE_SIZE", 100000)
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    def _fetch(self, aids: List[str]) -> Dict[str, dict]:
+        # Must retrieve all existing documents for the given aids with a single query
+        pass
+
+    def _store(self, aid: str, document: dict):
+        self._cache[aid] = document
+        self._cache.move_to_end(aid)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, aids: Iterable[str]) -> Dict[str, dict]:
+        documents, missing = {}, []
+        for aid in dict.fromkeys(aids):  # Unique, preserving order
+            if aid in self._cache:
+                self._cache.move_to_end(aid)
+                documents[aid] = self._cache[aid]
+            else:
+                missing.append(aid)
+        self.hits += len(documents)
+        self.misses += len(missing)
+
+        if missing:
+            for aid, document in self._fetch(missing).items():
+                self._store(aid, document)
+                documents[aid] = document
+        return documents
+
+    def update(self, aid: str, data: dict):
+        # Keeps the cache consistent with an upsert of data into the document
+        self._store(aid, {**self._cache.get(aid, {"_id": aid}), **data})
+
+    def entries(self) -> "OrderedDict[str, dict]":
+        # Cached documents from least to most recently used
+        return self._cache
+
+    def restore(self, entries: Dict[str, dict]):
+        for aid, document in entries.items():
+            self._store(aid, document)
+
+    def cache_info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._cache)}
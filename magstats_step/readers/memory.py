@@ -0,0 +1,16 @@
+import copy
+from typing import Dict, List
+
+from ._base import ObjectReader
+
+
+class InMemoryObjectReader(ObjectReader):
+    # Stand-in for a database, useful for testing. Keeps track of the number of queries
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.documents = {doc["_id"]: doc for doc in config.get("DOCUMENTS", [])}
+        self.queries = 0
+
+    def _fetch(self, aids: List[str]) -> Dict[str, dict]:
+        self.queries += 1
+        return {aid: copy.deepcopy(self.documents[aid]) for aid in aids if aid in self.documents}
@@ -0,0 +1,17 @@
+from typing import Dict, List
+
+from ._base import ObjectReader
+
+
+class MongoObjectReader(ObjectReader):
+    def __init__(self, config: dict):
+        super().__init__(config)
+        # pymongo is an optional dependency, only required when reading from MongoDB
+        from pymongo import MongoClient
+
+        # The client keeps a pool of connections (size given by maxPoolSize in PARAMS)
+        self.client = MongoClient(**config["PARAMS"])
+        self.collection = self.client[config["DATABASE"]][config.get("COLLECTION", "object")]
+
+    def _fetch(self, aids: List[str]) -> Dict[str, dict]:
+        return {doc["_id"]: doc for doc in self.collection.find({"_id": {"$in": aids}})}
@@ -0,0 +1,147 @@
+import functools
+import io
+import json
+import logging
+import os
+import time
+
+import fastavro
+from apf.producers import KafkaProducer
+
+from magstats_step.metrics import StageMetrics
+
+_SCHEMAS = os.path.join(os.path.dirname(__file__), "schemas")
+
+
+class JsonPayloadEncoder:
+    def encode(self, command: dict) -> dict:
+        return {"payload": json.dumps(command)}
+
+    def decode(self, message: dict) -> dict:
+        return json.loads(message["payload"])
+
+
+class AvroPayloadEncoder:
+    # Typed encoding of the command, messages must use the schema in scribe_schema_compact.avsc
+    VERSION = 1
+
+    def __init__(self):
+        with open(os.path.join(_SCHEMAS, f"object_update_v{self.VERSION}.avsc")) as f:
+            self.schema = fastavro.parse_schema(json.load(f))
+        data = next(field["type"] for field in self.schema["fields"] if field["name"] == "data")
+        self._data_fields = self._typed_fields(data)
+        magstats = next(field["type"] for field in data["fields"] if field["name"] == "magstats")
+        self._magstats_fields = self._typed_fields(magstats[1]["items"])
+
+    @staticmethod
+    def _typed_fields(schema: dict) -> set:
+        return {field["name"] for field in schema["fields"]} - {"extra", "absent"}
+
+    @staticmethod
+    def _split(record: dict, typed: set) -> dict:
+        split = {key: value for key, value in record.items() if key in typed}
+        split["extra"] = {key: value for key, value in record.items() if key not in typed}
+        split["absent"] = [key for key in typed if key not in record]
+        return split
+
+    @staticmethod
+    def _merge(split: dict) -> dict:
+        absent = set(split.pop("absent"))
+        record = {key: value for key, value in split.items() if key not in absent}
+        return record | record.pop("extra")
+
+    def encode(self, command: dict) -> dict:
+        data = self._split(command["data"], self._data_fields)
+        if data.get("magstats") is not None:
+            data["magstats"] = [self._split(magstats, self._magstats_fields) for magstats in data["magstats"]]
+        out = io.BytesIO()
+        fastavro.schemaless_writer(out, self.schema, command | {"data": data})
+        return {"schema_version": self.VERSION, "payload": out.getvalue()}
+
+    def decode(self, message: dict) -> dict:
+        if message["schema_version"] != self.VERSION:
+            raise ValueError(f"Unsupported schema version: {message['schema_version']}")
+        command = fastavro.schemaless_reader(io.BytesIO(message["payload"]), self.schema)
+        if command["data"]["magstats"] is not None:
+            command["data"]["magstats"] = [self._merge(magstats) for magstats in command["data"]["magstats"]]
+        command["data"] = self._merge(command["data"])
+        return command
+
+
+ENCODERS = {"json": JsonPayloadEncoder, "avro": AvroPayloadEncoder}
+
+
+class FlowControlledProducer:
+    # Wraps an apf producer, bounding the messages awaiting delivery and retrying with backoff on full queues.
+    # apf's KafkaProducer handles BufferError itself with a blocking flush, so its messages are serialized with the
+    # wrapped producer and sent through the underlying client instead. Other producers are called as they are
+    def __init__(self, producer, config: dict, metrics: StageMetrics = None):
+        self.producer = producer
+        # Underlying client (e.g., confluent_kafka.Producer in apf's KafkaProducer), used to serve delivery reports
+        self.client = getattr(producer, "producer", producer)
+        # Keep below the local queue size of the client (queue.buffering.max.messages), so that retries are rare
+        self.max_in_flight = config.get("MAX_IN_FLIGHT", 50000)
+        self.poll_every = config.get("POLL_EVERY", 1000)
+        self.max_retries = config.get("MAX_RETRIES", 5)
+        self.backoff = config.get("BACKOFF", 0.05)
+        self.metrics = metrics or StageMetrics()
+        self.in_flight = 0
+        self.produced = 0
+        self.delivered = 0
+        self.failed = 0
+        self.logger = logging.getLogger(f"alerce.{self.__class__.__name__}")
+
+    def set_key_field(self, key: str):
+        self.producer.set_key_field(key)
+
+    def _on_delivery(self, sent: float, on_delivery, err, msg):
+        self.in_flight -= 1
+        self.metrics.set_in_flight(self.in_flight)
+        self.metrics.observe_delivery(time.perf_counter() - sent, failed=err is not None)
+        if err is None:
+            self.delivered += 1
+        else:
+            self.failed += 1
+            self.logger.error(f"Failed to deliver scribe message: {err}")
+        if on_delivery is not None:
+            on_delivery(err, msg)
+
+    def poll(self, timeout: float = 0):
+        self.client.poll(timeout)
+
+    def _sends(self, message: dict, callback) -> list:
+        if not isinstance(self.producer, KafkaProducer):
+            return [functools.partial(self.producer.produce, message, on_delivery=callback)]
+        key = message[self.producer.key_field] if self.producer.key_field else None
+        value = self.producer._serialize_message(message)
+        topics = self.producer.topic_strategy.get_topics() if self.producer.dynamic_topic else self.producer.topic
+        return [
+            functools.partial(self.client.produce, topic, value=value, key=key, on_delivery=callback)
+            for topic in topics
+        ]
+
+    def produce(self, message: dict, on_delivery=None):
+        while self.in_flight >= self.max_in_flight:
+            self.poll(self.backoff)
+
+        callback = functools.partial(self._on_delivery, time.perf_counter(), on_delivery)
+        for send in self._sends(message, callback):  # One per topic, each gets its own delivery report
+            for attempt in range(self.max_retries + 1):
+                try:
+                    send()
+                    break
+                except BufferError:
+                    if attempt == self.max_retries:
+                        raise
+                    self.metrics.count_retry()
+                    # Serves delivery reports while waiting for room in the queue
+                    self.poll(self.backoff * 2**attempt)
+            self.in_flight += 1
+
+        self.produced += 1
+        self.metrics.set_in_flight(self.in_flight)
+        if self.produced % self.poll_every == 0:
+            self.poll(0)
+
+    def flush(self):
+        self.client.flush()
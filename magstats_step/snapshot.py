@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict
+
+
+class CacheSnapshot:
+    # Saves the cache of previous objects to a local file, so that it is warm again after a restart.
+    # Layout (little endian): magic, version, creation time and number of entries, followed by each entry from most
+    # to least recently used as key length (uint16), key, document length (uint32) and document (compact JSON)
+    MAGIC = b"MSCS"
+    VERSION = 1
+    _HEADER = struct.Struct("<4sHdI")
+    _KEY = struct.Struct("<H")
+    _DOCUMENT = struct.Struct("<I")
+
+    def __init__(self, config: dict):
+        self.path = config["PATH"]
+        self.every = config.get("EVERY", 300)  # Seconds between snapshots
+        # Least recently used entries are left out beyond this size
+        self.max_bytes = config.get("MAX_BYTES", 64 * 2**20)
+        # Older snapshots are ignored, documents may have changed since
+        self.max_age = config.get("MAX_AGE", 3600)
+        self.last = time.monotonic()
+        self.logger = logging.getLogger(f"alerce.{self.__class__.__name__}")
+
+    def due(self) -> bool:
+        return time.monotonic() - self.last >= self.every
+
+    def save(self, entries: Dict[str, dict]) -> int:
+        # Number of entries saved. Failures are logged and retried on the next snapshot, the step keeps consuming
+        chunks, size = [], self._HEADER.size
+        for key, document in reversed(entries.items()):
+            key = key.encode()
+            # Types without JSON representation (e.g., dates from the database) are kept as strings. At worst, the
+            # document differs from new data and the object is written again
+            document = json.dumps(document, separators=(",", ":"), default=str).encode()
+            try:
+                chunk = self._KEY.pack(len(key)) + key + self._DOCUMENT.pack(len(document)) + document
+            except struct.error:  # Lengths beyond the layout, such entries are only left out
+                self.logger.warning(f"Leaving out object with {len(key)} bytes key from snapshot {self.path}")
+                continue
+            if size + len(chunk) > self.max_bytes:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+
+        self.last = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.tmp", "wb") as f:
+                f.write(self._HEADER.pack(self.MAGIC, self.VERSION, time.time(), len(chunks)))
+                f.writelines(chunks)
+            os.replace(f"{self.path}.tmp", self.path)  # A partial snapshot is never left in place
+        except OSError as error:  # E.g., full disk, read-only volume or missing permissions
+            self.logger.error(f"Failed to save snapshot {self.path}: {error}")
+            return 0
+        self.logger.info(f"Saved {len(chunks)} of {len(entries)} cached objects ({size} bytes) to {self.path}")
+        return len(chunks)
+
+    def load(self) -> "OrderedDict[str, dict]":
+        # Entries from least to most recently used, as in the cache. Empty if missing, stale, corrupt or incompatible.
+        # The whole file is read at once, as every entry is decoded into the cache anyway
+        items = []
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            magic, version, created, count = self._HEADER.unpack_from(data)
+            if magic != self.MAGIC or version != self.VERSION:
+                self.logger.warning(f"Ignoring snapshot {self.path} with unsupported format (version {version})")
+                return OrderedDict()
+            if time.time() - created > self.max_age:
+                self.logger.info(f"Ignoring snapshot {self.path} older than {self.max_age} s")
+                return OrderedDict()
+            offset = self._HEADER.size
+            for _ in range(count):
+                (length,) = self._KEY.unpack_from(data, offset)
+                offset += self._KEY.size
+                key = data[offset : offset + length].decode()
+                offset += length
+                (length,) = self._DOCUMENT.unpack_from(data, offset)
+                offset += self._DOCUMENT.size
+                items.append((key, json.loads(data[offset : offset + length])))
+                offset += length
+        except FileNotFoundError:
+            return OrderedDict()
+        except OSError as error:
+            self.logger.warning(f"Ignoring unreadable snapshot {self.path}: {error}")
+            return OrderedDict()
+        except (ValueError, struct.error) as error:  # Includes empty files and invalid JSON or UTF-8
+            self.logger.warning(f"Ignoring corrupt snapshot {self.path}: {error}")
+            return OrderedDict()
+        self.logger.info(f"Loaded {len(items)} cached objects from {self.path}")
+        return OrderedDict(reversed(items))
@@ -1,40 +1,212 @@
-import json
-from typing import List
+import functools
+import logging
+import random
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, Iterator, List, Set, Tuple, Union
 
 import numpy as np
+import pandas as pd
 from apf.core.step import GenericStep, get_class
 
-from magstats_step.core import MagnitudeStatistics, ObjectStatistics
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics, calculate_records, calculate_statistics
+from magstats_step.core._base import BaseStatistics
+from magstats_step.deadline import DeadlinePlanner
+from magstats_step.export import ColumnarSink
+from magstats_step.metrics import PrometheusStageMetrics, StageMetrics
+from magstats_step.profiling import MemoryProfiler, SamplingProfiler
+from magstats_step.scribe import ENCODERS, FlowControlledProducer
+from magstats_step.snapshot import CacheSnapshot
+from magstats_step.synthetic import generate_messages
+
+
+class StopConsuming(Exception):
+    # Raised to leave the consumer loop once a stop is requested, then the step is torn down
+    pass
 
 
 class MagstatsStep(GenericStep):
     def __init__(
         self,
         config,
+        startup_time: float = None,
         **step_args,
     ):
         super().__init__(config=config, **step_args)
+        # Reference from perf_counter used to report the time until the first batch is processed
+        self.startup_time = time.perf_counter() if startup_time is None else startup_time
+        self.warm_up_enabled = config.get("WARM_UP", False)
         self.excluded = set(config["EXCLUDED_CALCULATORS"])
+        self.calculators = set(ObjectStatistics.calculators()) | set(MagnitudeStatistics.calculators())
+        self.calculators -= {name.removeprefix("calculate_") for name in self.excluded}
+        # Maximum number of rows (detections and non-detections) per chunk. Zero disables chunking
+        self.max_chunk_rows = config.get("MAX_CHUNK_ROWS", 0)
+        # Lengths in days of the windows for recent magnitude statistics, none by default
+        self.windows = config.get("MAGSTATS_WINDOWS", [])
+        # Threads running the calculators of both classes concurrently. Zero runs them one after another
+        threads = config.get("CALCULATOR_THREADS", 0)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="calculator") if threads else None
+        # Orders of the HEALPix (nested) sky index computed from the mean coordinates, none by default
+        self.healpix_orders = config.get("HEALPIX_ORDERS", [])
+        # Batches (or chunks) with up to this many rows are computed without frames. Zero always uses frames
+        self.fast_path_rows = config.get("FAST_PATH_ROWS", 0)
+
+        prometheus_config = config.get("PROMETHEUS_CONFIG", {})
+        if prometheus_config.get("ENABLED"):
+            self.stage_metrics = PrometheusStageMetrics()
+            if prometheus_config.get("SERVE", True):
+                self.stage_metrics.serve(prometheus_config["PORT"])
+        else:
+            self.stage_metrics = StageMetrics()
+        memory_config = config.get("MEMORY_PROFILING_CONFIG", {})
+        self.memory_profiler = MemoryProfiler(memory_config, self.stage_metrics) if memory_config else None
+        sampling_config = config.get("SAMPLING_PROFILER_CONFIG", {})
+        self.sampling_profiler = SamplingProfiler(sampling_config) if sampling_config else None
+        self.profile_on_start = sampling_config.get("ON_START", False)
+
         cls = get_class(config["SCRIBE_PRODUCER_CONFIG"]["CLASS"])
         self.scribe_producer = cls(config["SCRIBE_PRODUCER_CONFIG"])
+        flow_control_config = config.get("SCRIBE_FLOW_CONTROL")
+        if flow_control_config:
+            self.scribe_producer = FlowControlledProducer(self.scribe_producer, flow_control_config, self.stage_metrics)
+        # Key by aid so all updates for an object go to the same partition, in order
+        self.scribe_producer.set_key_field("aid")
+        self.scribe_encoder = ENCODERS[config.get("SCRIBE_ENCODING", "json")]()
+
+        # Expensive calculators can be deferred for batches expected to exceed their deadline
+        deadline_config = config.get("DEADLINE_CONFIG")
+        self.deadline = DeadlinePlanner(deadline_config) if deadline_config else None
+        # Only object statistics can be deferred. Magnitude statistics are written as a whole list per object, so a
+        # partial one would overwrite the stored values of the deferred calculators
+        self.deferrable = self.calculators & (
+            set(ObjectStatistics.calculators()) - set(MagnitudeStatistics.calculators())
+        )
+        if self.deadline and self.deadline.expensive - self.deferrable:
+            self.logger.warning(f"Calculators {sorted(self.deadline.expensive - self.deferrable)} are never deferred")
+        # Rows of the objects with deferred statistics, oldest first. They only live in memory, so offsets are not
+        # committed while any is pending and a restart computes them again from the uncommitted batches
+        self.deferred: Dict[str, Tuple[list, list]] = OrderedDict()
+        self.commits = self.commit  # As configured, commits are held back while statistics are deferred
+        self.held_batches = 0
+        self.batch_start = None
+        # Shared timestamp updated after each batch, set when running under a supervisor
+        self.heartbeat = None
+        # A stop request (e.g., SIGTERM) is only honored between batches, after they are produced and committed
+        self.stopping = False
+        self.in_batch = False
+
+        # Aggregated metrics (counts and a sample of aids) replace the per message EXTRA_METRICS when configured
+        self.compact_metrics = config.get("COMPACT_METRICS_CONFIG")
+
+        # Statistics are also appended to local columnar files when a sink is configured
+        sink_config = config.get("COLUMNAR_SINK_CONFIG")
+        self.sink = ColumnarSink(sink_config) if sink_config else None
+
+        # Previous state of the objects is only read when a reader is configured
+        reader_config = config.get("OBJECT_READER_CONFIG")
+        self.object_reader = get_class(reader_config["CLASS"])(reader_config) if reader_config else None
+        self.previous = {}
+        # Objects whose previous document already holds the new statistics are not written again. Opt-in, as the
+        # cache is only as good as its updates, which are only done once writes are confirmed as delivered
+        self.skip_unchanged = config.get("SKIP_UNCHANGED", False)
+        # The cache of the reader is saved periodically and loaded back on startup, before consuming
+        snapshot_config = config.get("CACHE_SNAPSHOT_CONFIG")
+        self.snapshot = CacheSnapshot(snapshot_config) if snapshot_config and self.object_reader else None
+        if self.snapshot:
+            self.object_reader.restore(self.snapshot.load())
+
+    def warm_up(self, n_messages: int = 20):
+        # Runs the full computation once, so one-time costs are not paid by the first real batch
+        start = time.perf_counter()
+        self.calculate(**self.pre_execute(generate_messages(n_messages, seed=0)))
+        self.logger.info(f"Warm-up finished in {time.perf_counter() - start:.3f} s")
+
+    def pre_consume(self):
+        self.logger.info(f"Step ready {time.perf_counter() - self.startup_time:.3f} s after startup")
+        if self.sampling_profiler and self.profile_on_start:
+            self.sampling_profiler.start()
+        if self.warm_up_enabled:
+            self.warm_up()
+
+    def start(self):
+        try:
+            super().start()
+        except StopConsuming:
+            self.logger.info("Stop requested, no more messages will be consumed")
+            self._tear_down()
+
+    def stop(self, *_):
+        # Can be used as signal handler
+        self.stopping = True
+        if not self.in_batch:  # Waiting for messages
+            raise StopConsuming()
+
+    def _pre_execute(self, message: Union[dict, List[dict]]) -> dict:
+        self.in_batch = True
+        self.batch_start = time.perf_counter()
+        if self.memory_profiler:
+            self.memory_profiler.start_batch()
+        with self.stage_metrics.time_stage("pre_execute"):
+            preprocessed = super()._pre_execute(message)
+        self.stage_metrics.observe_batch(
+            messages=len(self.message),
+            detections=len(preprocessed["detections"]),
+            non_detections=len(preprocessed["non_detections"]),
+            aids=len({msg["aid"] for msg in self.message}),
+        )
+        if self.skip_unchanged:  # Previous documents are only compared to skip unchanged objects
+            with self.stage_metrics.time_stage("read_previous"):
+                self.previous = self.object_reader.get(msg["aid"] for msg in self.message)
+        return preprocessed
 
     @classmethod
     def pre_execute(cls, messages: List[dict]) -> dict:
-        detections, non_detections = [], []
+        # Messages for the same aid repeat its history, only the first appearance of each alert is kept
+        detections, non_detections, candids, keys = [], [], set(), set()
         for msg in messages:
-            detections.extend(msg["detections"])
-            non_detections.extend(msg["non_detections"])
+            for detection in msg["detections"]:
+                if detection["candid"] not in candids:
+                    candids.add(detection["candid"])
+                    detections.append(detection)
+            for non_detection in msg["non_detections"]:
+                key = (non_detection["oid"], non_detection["fid"], non_detection["mjd"])
+                if key not in keys:
+                    keys.add(key)
+                    non_detections.append(non_detection)
         return {"detections": detections, "non_detections": non_detections}
 
-    def execute(self, messages: dict):
-        obj_calculator = ObjectStatistics(messages["detections"])
-        stats = obj_calculator.generate_statistics(self.excluded).replace({np.nan: None})
+    @staticmethod
+    def group_by_aid(messages: dict) -> Dict[str, Tuple[list, list]]:
+        by_aid = {}
+        for detection in messages["detections"]:
+            by_aid.setdefault(detection["aid"], ([], []))[0].append(detection)
+        for non_detection in messages["non_detections"]:
+            if non_detection["aid"] in by_aid:  # Objects without detections produce no output
+                by_aid[non_detection["aid"]][1].append(non_detection)
+        return by_aid
 
-        stats = stats.to_dict("index")
+    @classmethod
+    def split_by_aid(cls, messages: dict, max_rows: int) -> Iterator[dict]:
+        # Objects are never split across chunks, so an object larger than max_rows makes up its own chunk
+        chunk, rows = {"detections": [], "non_detections": []}, 0
+        for detections, non_detections in cls.group_by_aid(messages).values():
+            size = len(detections) + len(non_detections)
+            if rows and rows + size > max_rows:
+                yield chunk
+                chunk, rows = {"detections": [], "non_detections": []}, 0
+            chunk["detections"].extend(detections)
+            chunk["non_detections"].extend(non_detections)
+            rows += size
+        if rows:
+            yield chunk
 
-        magstats_calculator = MagnitudeStatistics(**messages)
-        magstats = magstats_calculator.generate_statistics(self.excluded).reset_index()
-        magstats = magstats.set_index("aid").replace({np.nan: None})
+    @staticmethod
+    def assemble(stats: pd.DataFrame, magstats: pd.DataFrame) -> dict:
+        stats = stats.replace({np.nan: None}).to_dict("index")
+
+        magstats = magstats.reset_index().set_index("aid").replace({np.nan: None})
         for aid in stats:
             try:
                 stats[aid]["magstats"] = magstats.loc[aid].to_dict("records")
@@ -43,17 +215,208 @@ class MagstatsStep(GenericStep):
 
         return stats
 
+    def _release(self, calculator: BaseStatistics):
+        if self.logger.isEnabledFor(logging.DEBUG):  # Computing the size of the cache is not free
+            self.logger.debug(f"Intermediate cache for {type(calculator).__name__}: {calculator.cache_info()}")
+        if self.memory_profiler:
+            self.memory_profiler.observe_calculator(calculator)
+
+    def statistics(
+        self, detections: List[dict], non_detections: List[dict], excluded: Set[str]
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        with self.stage_metrics.time_stage("concurrent_calculators") if self.executor else nullcontext():
+            return calculate_statistics(
+                detections,
+                non_detections,
+                exclude=excluded,
+                windows=self.windows,
+                healpix_orders=self.healpix_orders,
+                executor=self.executor,
+                timer=self.stage_metrics.time_calculator,
+                on_release=self._release,
+            )
+
+    def calculate(self, detections: List[dict], non_detections: List[dict], excluded: Set[str] = None) -> dict:
+        excluded = self.excluded if excluded is None else excluded
+        if self.fast_path_rows and len(detections) + len(non_detections) <= self.fast_path_rows:
+            with self.stage_metrics.time_stage("fast_path"):
+                return calculate_records(
+                    detections,
+                    non_detections,
+                    exclude=excluded,
+                    windows=self.windows,
+                    healpix_orders=self.healpix_orders,
+                )
+
+        stats, magstats = self.statistics(detections, non_detections, excluded)
+        with self.stage_metrics.time_stage("assemble"):
+            return self.assemble(stats, magstats)
+
+    def calculate_batch(self, detections: List[dict], non_detections: List[dict], excluded: Set[str]) -> dict:
+        # Only consumed batches are appended to the sink, never warm-up recomputations. Objects with deferred
+        # statistics are appended once complete, when caught up
+        if not self.sink or excluded != self.excluded:
+            return self.calculate(detections, non_detections, excluded)
+
+        stats, magstats = self.statistics(detections, non_detections, excluded)
+        with self.stage_metrics.time_stage("columnar_sink"):
+            self.sink.write(stats, magstats)
+        with self.stage_metrics.time_stage("assemble"):
+            return self.assemble(stats, magstats)
+
+    def execute_chunks(self, messages: dict, excluded: Set[str]) -> Iterator[dict]:
+        for chunk in self.split_by_aid(messages, self.max_chunk_rows):
+            yield self.calculate_batch(**chunk, excluded=excluded)
+
+    def execute(self, messages: dict) -> Union[dict, Iterator[dict]]:
+        excluded = self.excluded | self.defer(messages) if self.deadline else self.excluded
+        if self.max_chunk_rows:
+            return self.execute_chunks(messages, excluded)
+        return self.calculate_batch(**messages, excluded=excluded)
+
+    def defer(self, messages: dict) -> Set[str]:
+        by_aid = self.group_by_aid(messages)
+        for aid in by_aid:  # Newer rows supersede any pending catch-up for the object
+            self.deferred.pop(aid, None)
+        if len(self.deferred) >= self.deadline.max_deferred:  # Backlog is full, it has to drain first
+            return set()
+        rows = len(messages["detections"]), len(messages["non_detections"])
+        deferred = self.deadline.plan(self.calculators, *rows) & self.deferrable
+        if deferred:
+            self.logger.info(f"Batch expected to exceed its deadline, deferring {sorted(deferred)}")
+            self.deferred.update(by_aid)
+        return deferred
+
+    def catch_up(self, deadline: float = None):
+        # Sends full updates for objects with deferred statistics while there is time left (all without a deadline)
+        while self.deferred:
+            aids, chunk = [], {"detections": [], "non_detections": []}
+            for aid, (detections, non_detections) in self.deferred.items():
+                if aids and len(chunk["detections"]) + len(chunk["non_detections"]) >= self.deadline.catch_up_rows:
+                    break
+                aids.append(aid)
+                chunk["detections"].extend(detections)
+                chunk["non_detections"].extend(non_detections)
+
+            cost = self.deadline.estimate(self.calculators, len(chunk["detections"]), len(chunk["non_detections"]))
+            overflow = len(self.deferred) > self.deadline.max_deferred
+            if deadline is not None and not overflow and time.perf_counter() + cost > deadline:
+                break
+            for aid in aids:
+                del self.deferred[aid]
+            with self.stage_metrics.time_stage("catch_up"):
+                result = self.calculate_batch(**chunk, excluded=self.excluded)
+            self.produce_scribe(result)
+
     def produce_scribe(self, result: dict):
+        with self.stage_metrics.time_stage("produce_scribe"):
+            self._produce_scribe(result)
+
+    def is_unchanged(self, aid: str, data: dict) -> bool:
+        previous = self.previous.get(aid)
+        return previous is not None and all(key in previous and previous[key] == value for key, value in data.items())
+
+    @staticmethod
+    def build_command(aid: str, stats: dict) -> dict:
+        data = stats
+        if "meanra" in stats:  # Coordinates are missing when deferred
+            data = stats | {"loc": {"type": "Point", "coordinates": [stats["meanra"] - 180, stats["meandec"]]}}
+        return {
+            "collection": "object",
+            "type": "update",
+            "criteria": {"_id": aid},
+            "data": data,
+            "options": {"upsert": True},
+        }
+
+    def _delivered(self, aid: str, data: dict, err, msg):
+        if err is None:  # The cache must never claim a write that did not happen
+            self.object_reader.update(aid, data)
+
+    def _produce_scribe(self, result: dict):
+        unchanged = 0
         for aid, stats in result.items():
-            command = {
-                "collection": "object",
-                "type": "update",
-                "criteria": {"_id": aid},
-                "data": stats | {"loc": {"type": "Point", "coordinates": [stats["meanra"] - 180, stats["meandec"]]}},
-                "options": {"upsert": True},
-            }
-            self.scribe_producer.produce({"payload": json.dumps(command)})
-
-    def post_execute(self, result: dict):
-        self.produce_scribe(result)
+            command = self.build_command(aid, stats)
+            kwargs = {}
+            if self.object_reader:
+                if self.skip_unchanged and self.is_unchanged(aid, command["data"]):  # Write would change nothing
+                    unchanged += 1
+                    continue
+                kwargs["on_delivery"] = functools.partial(self._delivered, aid, command["data"])
+            # The aid is only used as message key, it is not part of the scribe schema
+            self.scribe_producer.produce(self.scribe_encoder.encode(command) | {"aid": aid}, **kwargs)
+        if unchanged:
+            self.logger.info(f"Skipped {unchanged} objects without changes")
+
+    def get_extra_metrics(self, message: Union[dict, List[dict]]) -> dict:
+        if not self.compact_metrics:
+            return super().get_extra_metrics(message)
+        messages = message if isinstance(message, list) else [message]
+        aids = list({msg["aid"] for msg in messages})
+        surveys, bands = Counter(), Counter()
+        for msg in messages:
+            surveys.update(detection["sid"] for detection in msg["detections"])
+            bands.update((detection["sid"], detection["fid"]) for detection in msg["detections"])
+        by_band = {}
+        for (sid, fid), count in bands.items():
+            by_band.setdefault(sid, {})[str(fid)] = count
+        return {
+            "n_messages": len(messages),
+            "n_detections": sum(surveys.values()),
+            "n_non_detections": sum(len(msg["non_detections"]) for msg in messages),
+            "n_aids": len(aids),
+            "aid_sample": random.sample(aids, min(self.compact_metrics.get("AID_SAMPLE", 10), len(aids))),
+            "detections_by_survey": dict(surveys),
+            "detections_by_band": by_band,
+        }
+
+    def post_execute(self, result: Union[dict, Iterator[dict]]):
+        if isinstance(result, dict):
+            self.produce_scribe(result)
+        else:  # Chunks are computed lazily, so only one of them is held in memory at any given time
+            for chunk in result:
+                self.produce_scribe(chunk)
+            result = {}
+        if isinstance(self.scribe_producer, FlowControlledProducer):
+            self.scribe_producer.poll(0)  # Serve pending delivery reports before the next batch
+        if self.deadline:
+            if self.held_batches >= self.deadline.max_held_batches:  # Commits cannot be held back any longer
+                self.logger.info(f"Catching up with {len(self.deferred)} deferred objects to commit")
+                self.catch_up()
+            else:
+                self.catch_up(self.batch_start + self.deadline.budget)
+            self.held_batches = self.held_batches + 1 if self.deferred else 0
+            self.commit = self.commits and not self.deferred
+        if self.snapshot and self.snapshot.due():
+            with self.stage_metrics.time_stage("cache_snapshot"):
+                self.snapshot.save(self.object_reader.entries())
+        if self.memory_profiler:
+            self.memory_profiler.end_batch()
+        if self.heartbeat is not None:
+            self.heartbeat.value = time.time()
+        if self.startup_time is not None:
+            self.logger.info(f"First batch processed {time.perf_counter() - self.startup_time:.3f} s after startup")
+            self.startup_time = None
         return result
+
+    def post_produce(self):
+        self.in_batch = False
+        if self.stopping:
+            raise StopConsuming()
+
+    def tear_down(self):
+        if self.deadline:
+            self.catch_up()
+        if isinstance(self.scribe_producer, FlowControlledProducer):
+            self.scribe_producer.flush()
+        if self.commits and not self.commit:  # Offsets held back for the deferred statistics just caught up
+            self.consumer.commit()
+            self.commit = True
+        if self.snapshot:
+            self.snapshot.save(self.object_reader.entries())
+        if self.executor:
+            self.executor.shutdown()
+        if self.sink:
+            self.sink.close()
+            if self.sink.date:  # Only the partitions written by this run
+                self.sink.compact(self.sink.date)
@@ -0,0 +1,102 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from typing import Callable, Dict, Tuple
+
+
+class Supervisor:
+    # Runs several workers (each one a step in the same consumer group) and restarts those that crash or hang.
+    # Workers are forked, so they share the modules already imported by the supervisor
+    def __init__(self, target: Callable[[int, "multiprocessing.Value"], None], config: dict):
+        self.target = target
+        self.n_workers = config.get("WORKERS", 2)
+        self.restart_delay = config.get("RESTART_DELAY", 1.0)
+        # Seconds without a heartbeat (one per batch) before a worker is considered hung. Zero disables the check,
+        # which is the safe choice when topics can be idle for long
+        self.heartbeat_timeout = config.get("HEARTBEAT_TIMEOUT", 0)
+        self.check_every = config.get("CHECK_EVERY", 1.0)
+        self.stop_timeout = config.get("STOP_TIMEOUT", 30)
+        self.context = multiprocessing.get_context("fork")
+        self.workers: Dict[int, Tuple[multiprocessing.Process, multiprocessing.Value]] = {}
+        self.restarts = 0
+        self.stopping = False
+        self._handlers = {}  # Signal handlers in place before running, restored for the workers
+        self.logger = logging.getLogger(f"alerce.{self.__class__.__name__}")
+
+    @staticmethod
+    def serve_metrics(port: int):
+        # Aggregates the metrics written by all workers, requires PROMETHEUS_MULTIPROC_DIR set before they start
+        from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+
+    def _run(self, index: int, heartbeat: "multiprocessing.Value"):
+        # Forked workers inherit the handlers that only stop the supervisor, so they would ignore terminate()
+        for signum, handler in self._handlers.items():
+            signal.signal(signum, handler)
+        self.target(index, heartbeat)
+
+    def _start(self, index: int):
+        heartbeat = self.context.Value("d", time.time(), lock=False)
+        process = self.context.Process(target=self._run, args=(index, heartbeat), name=f"magstats-worker-{index}")
+        process.start()
+        self.workers[index] = (process, heartbeat)
+        self.logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def _exited(self, process: multiprocessing.Process):
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):  # Drops live gauges of the process from the aggregation
+            from prometheus_client import multiprocess
+
+            multiprocess.mark_process_dead(process.pid)
+
+    def check(self):
+        for index, (process, heartbeat) in list(self.workers.items()):
+            if process.is_alive():
+                if not self.heartbeat_timeout or time.time() - heartbeat.value <= self.heartbeat_timeout:
+                    continue
+                self.logger.warning(f"Worker {index} sent no heartbeat in {self.heartbeat_timeout} s, killing it")
+                process.kill()
+                process.join()
+
+            self._exited(process)
+            if process.exitcode == 0:
+                self.logger.info(f"Worker {index} finished")
+                del self.workers[index]
+                continue
+            self.logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+            self.restarts += 1
+            time.sleep(self.restart_delay)
+            self._start(index)
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def shutdown(self):
+        for process, _ in self.workers.values():
+            process.terminate()
+        deadline = time.time() + self.stop_timeout
+        for process, _ in self.workers.values():
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+            self._exited(process)
+        self.workers.clear()
+
+    def run(self):
+        self._handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            for index in range(self.n_workers):
+                self._start(index)
+            while self.workers and not self.stopping:
+                time.sleep(self.check_every)
+                self.check()
+        finally:
+            self.shutdown()
+            for signum, handler in self._handlers.items():
+                signal.signal(signum, handler)
+        self.logger.info(f"All workers stopped after {self.restarts} restarts")
@@ -0,0 +1,77 @@
+import random
+from typing import List
+
+_SURVEYS = {"ZTF": ("ZTF", ["g", "r"]), "ATLAS": ("ATLAS-01a", ["c", "o"])}
+
+
+def _detection(
+    rng: random.Random, aid: str, oid: str, survey: str, fid: str, mjd: float, ra: float, dec: float
+) -> dict:
+    tid, _ = _SURVEYS[survey]
+    corrected = survey == "ZTF" and rng.random() < 0.8
+    mag = rng.uniform(15, 21)
+    candid = rng.randrange(10**18)
+    return {
+        "aid": aid,
+        "oid": oid,
+        "sid": survey,
+        "pid": candid,
+        "tid": tid,
+        "fid": fid,
+        "candid": candid,
+        "mjd": mjd,
+        "ra": (ra + rng.gauss(0, 1e-4)) % 360,
+        "e_ra": rng.uniform(0.05, 0.5),
+        "dec": min(max(dec + rng.gauss(0, 1e-4), -90), 90),
+        "e_dec": rng.uniform(0.05, 0.5),
+        "mag": mag,
+        "e_mag": rng.uniform(0.01, 0.2),
+        "mag_corr": mag - rng.uniform(0, 1) if corrected else None,
+        "e_mag_corr": rng.uniform(0.01, 0.2) if corrected else None,
+        "e_mag_corr_ext": rng.uniform(0.01, 0.2) if corrected else None,
+        "isdiffpos": 1 if rng.random() < 0.8 else -1,
+        "corrected": corrected,
+        "dubious": rng.random() < 0.05,
+        "stellar": rng.random() < 0.3,
+        "forced": False,
+        "parent_candid": None,
+        "extra_fields": {},
+    }
+
+
+def _non_detection(rng: random.Random, aid: str, oid: str, survey: str, fid: str, mjd: float) -> dict:
+    tid, _ = _SURVEYS[survey]
+    return {
+        "aid": aid,
+        "oid": oid,
+        "sid": survey,
+        "tid": tid,
+        "fid": fid,
+        "mjd": mjd,
+        "diffmaglim": rng.uniform(19, 21),
+    }
+
+
+def generate_messages(
+    n_messages: int = 10, n_detections: int = 10, n_non_detections: int = 5, seed: int = None
+) -> List[dict]:
+    # Non-detections precede the first detection, so that every statistic has data to work with
+    rng = random.Random(seed)
+    messages = []
+    for i in range(n_messages):
+        aid = f"AL{rng.randrange(10**16):016d}"
+        survey = rng.choice(list(_SURVEYS))
+        oid = f"{survey}{i:09d}"
+        _, fids = _SURVEYS[survey]
+        start = rng.uniform(58000, 60000)
+        ra, dec = rng.uniform(0, 360), rng.uniform(-90, 90)
+        detections = [
+            _detection(rng, aid, oid, survey, rng.choice(fids), start + rng.uniform(0, 100), ra, dec)
+            for _ in range(n_detections)
+        ]
+        non_detections = [
+            _non_detection(rng, aid, oid, survey, rng.choice(fids), start - rng.uniform(1, 50))
+            for _ in range(n_non_detections)
+        ]
+        messages.append({"aid": aid, "detections": detections, "non_detections": non_detections})
+    return messages
@@ -1,5 +1,11 @@
+import time
+
+START_TIME = time.perf_counter()  # Taken before any other import to include them in the startup time
+
 import os
+import signal
 import sys
+import tempfile
 
 import logging
 
@@ -9,12 +15,7 @@ PACKAGE_PATH = os.path.abspath(os.path.join(SCRIPT_PATH, ".."))
 sys.path.append(PACKAGE_PATH)
 
 
-def step_factory():
-    from magstats_step.step import MagstatsStep
-    from settings import settings_factory
-
-    step_config = settings_factory()
-
+def configure_logging():
     level = logging.INFO
     if os.getenv('LOGGING_DEBUG'):
         level = logging.DEBUG
@@ -28,9 +29,63 @@ def step_factory():
     handler.setLevel(level)
 
     logger.addHandler(handler)
+    return logger
+
+
+def step_factory():
+    # Heavy imports are deferred until the step is actually built
+    from magstats_step.step import MagstatsStep
+    from settings import settings_factory
+
+    step_config = settings_factory()
+
+    logger = configure_logging()
+    logger.info(f"Step modules imported {time.perf_counter() - START_TIME:.3f} s after startup")
+
+    return MagstatsStep(config=step_config, startup_time=START_TIME)
+
+
+def run(step):
+    # Stops after the current batch, tearing down the step (flushes the producers, closes the sink, etc.)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, step.stop)
+    step.start()
+
+
+def run_worker(index, heartbeat):
+    os.environ["WORKER_INDEX"] = str(index)  # Keeps per worker state (e.g., cache snapshots) apart
+    step = step_factory()
+    step.heartbeat = heartbeat
+    run(step)
+
+
+def supervise(n_workers):
+    if os.getenv("USE_PROMETHEUS"):
+        # Must be set before prometheus_client is imported, so that every process writes its metrics to shared files
+        os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="magstats-metrics-"))
+
+    # Imported before forking, so workers share them instead of importing them again
+    import magstats_step.step  # noqa: F401
+    from magstats_step.supervisor import Supervisor
 
-    return MagstatsStep(config=step_config)
+    configure_logging()
+    supervisor = Supervisor(
+        run_worker,
+        {
+            "WORKERS": n_workers,
+            "RESTART_DELAY": float(os.getenv("WORKER_RESTART_DELAY", 1)),
+            "HEARTBEAT_TIMEOUT": float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", 0)),
+        },
+    )
+    if os.getenv("USE_PROMETHEUS"):
+        supervisor.serve_metrics(int(os.getenv("PROMETHEUS_PORT", 8000)))
+    supervisor.run()
 
 
 if __name__ == "__main__":
-    step_factory().start()
+    # Several workers in the same consumer group under a supervisor, or a single step in this process
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1:
+        supervise(workers)
+    else:
+        run(step_factory())
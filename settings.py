@@ -1,12 +1,25 @@
 import os
-from fastavro import schema
 
 
 def settings_factory():
+    from fastavro import schema  # Imported here, so it is only loaded when the settings are built
+
     # Set the global logging level to debug
     logging_debug = os.getenv("LOGGING_DEBUG", False)
 
     excluded_calculators = os.getenv("EXCLUDED_CALCULATORS", "").strip().split(",")
+    # Maximum number of rows per chunk, where each chunk is processed and produced separately (0 disables)
+    max_chunk_rows = int(os.getenv("MAX_CHUNK_ROWS", 0))
+    # Comma separated lengths in days of the windows for recent magnitude statistics (e.g., "7,30")
+    magstats_windows = [float(window) for window in os.getenv("MAGSTATS_WINDOWS", "").split(",") if window.strip()]
+    # Comma separated orders of the HEALPix nested sky index for the mean coordinates (e.g., "10,14")
+    healpix_orders = [int(order) for order in os.getenv("HEALPIX_ORDERS", "").split(",") if order.strip()]
+    # Batches with up to this many rows are computed with arrays instead of frames, faster when small (0 disables)
+    fast_path_rows = int(os.getenv("FAST_PATH_ROWS", 0))
+    # Threads to run the calculators concurrently (0 runs them one after another)
+    calculator_threads = int(os.getenv("CALCULATOR_THREADS", 0))
+    # Run the calculators over a small synthetic batch before consuming
+    warm_up = bool(os.getenv("WARM_UP"))
     # Consumer configuration
     # Each consumer has different parameters and can be found in the documentation
     consumer_config = {
@@ -22,13 +35,23 @@ def settings_factory():
         "consume.timeout": int(os.getenv("CONSUME_TIMEOUT", 0)),
     }
 
+    # Payload encoding for scribe commands, either "json" or the compact "avro"
+    scribe_encoding = os.getenv("SCRIBE_ENCODING", "json")
+    scribe_schema = "scribe_schema_compact.avsc" if scribe_encoding == "avro" else "scribe_schema.avsc"
     scribe_producer_config = {
         "CLASS": os.getenv("SCRIBE_PRODUCER_CLASS", "apf.producers.KafkaProducer"),
         "PARAMS": {
             "bootstrap.servers": os.environ["SCRIBE_PRODUCER_SERVER"],
+            # Messages are keyed by aid, batching is done per partition
+            "linger.ms": int(os.getenv("SCRIBE_LINGER_MS", 50)),
+            "batch.num.messages": int(os.getenv("SCRIBE_BATCH_NUM_MESSAGES", 10000)),
+            "batch.size": int(os.getenv("SCRIBE_BATCH_SIZE", 1000000)),
+            "compression.type": os.getenv("SCRIBE_COMPRESSION_TYPE", "lz4"),
+            # Idempotence keeps the order of messages with the same key even when sends are retried
+            "enable.idempotence": bool(os.getenv("SCRIBE_ENABLE_IDEMPOTENCE")),
         },
         "TOPIC": os.environ["SCRIBE_PRODUCER_TOPIC"],
-        "SCHEMA": schema.load_schema("scribe_schema.avsc"),
+        "SCHEMA": schema.load_schema(scribe_schema),
     }
 
     metrics_config = {
@@ -74,6 +97,82 @@ def settings_factory():
         },
     }
 
+    # Bounds the scribe messages awaiting delivery, retrying with exponential backoff when the queue is full
+    scribe_flow_control = {
+        "MAX_IN_FLIGHT": int(os.getenv("SCRIBE_MAX_IN_FLIGHT", 50000)),
+        "POLL_EVERY": int(os.getenv("SCRIBE_POLL_EVERY", 1000)),
+        "MAX_RETRIES": int(os.getenv("SCRIBE_MAX_RETRIES", 5)),
+        "BACKOFF": float(os.getenv("SCRIBE_BACKOFF", 0.05)),
+    }
+
+    # Memory used by each batch, with allocation sites traced every TRACEMALLOC_EVERY batches (0 disables tracing)
+    memory_profiling_config = {
+        "TRACEMALLOC_EVERY": int(os.getenv("TRACEMALLOC_EVERY", 100)),
+        "TOP": int(os.getenv("TRACEMALLOC_TOP", 10)),
+    }
+
+    # Expensive calculators are deferred when a batch is expected to take longer than DEADLINE_BUDGET seconds
+    deadline_config = {
+        "BUDGET": float(os.getenv("DEADLINE_BUDGET", 0)),
+        "EXPENSIVE": os.getenv("DEADLINE_EXPENSIVE", "ra,dec").split(","),
+        "MAX_DEFERRED": int(os.getenv("DEADLINE_MAX_DEFERRED", 100000)),
+        "CATCH_UP_ROWS": int(os.getenv("DEADLINE_CATCH_UP_ROWS", 10000)),
+        "MAX_HELD_BATCHES": int(os.getenv("DEADLINE_MAX_HELD_BATCHES", 100)),
+    }
+
+    # Local columnar files with the statistics of each batch, partitioned by date and aid prefix
+    columnar_sink_config = {
+        "PATH": os.getenv("COLUMNAR_SINK_PATH"),
+        "FORMAT": os.getenv("COLUMNAR_SINK_FORMAT", "parquet"),
+        "AID_PREFIX_LENGTH": int(os.getenv("COLUMNAR_SINK_AID_PREFIX_LENGTH", 4)),
+        "ROLLOVER_ROWS": int(os.getenv("COLUMNAR_SINK_ROLLOVER_ROWS", 1000000)),
+        "COMPACT_FILES": int(os.getenv("COLUMNAR_SINK_COMPACT_FILES", 8)),
+    }
+
+    # Snapshots of the cache of previous objects, one file per worker, loaded back on startup
+    cache_snapshot_config = {
+        "PATH": os.path.join(os.getenv("CACHE_SNAPSHOT_DIR", ""), f"objects-{os.getenv('WORKER_INDEX', 0)}.snapshot"),
+        "EVERY": float(os.getenv("CACHE_SNAPSHOT_EVERY", 300)),
+        "MAX_BYTES": int(os.getenv("CACHE_SNAPSHOT_MAX_BYTES", 64 * 2**20)),
+        "MAX_AGE": float(os.getenv("CACHE_SNAPSHOT_MAX_AGE", 3600)),
+    }
+
+    # Metrics of each batch with counts and a bounded sample of aids instead of every aid (EXTRA_METRICS)
+    compact_metrics_config = {"AID_SAMPLE": int(os.getenv("METRICS_AID_SAMPLE", 10))}
+
+    # Samples the stacks of the step for DURATION seconds, when receiving SIGNAL or right before consuming
+    sampling_profiler_config = {
+        "SIGNAL": os.getenv("PROFILER_SIGNAL", "SIGUSR2"),
+        "ON_START": bool(os.getenv("PROFILER_ON_START")),
+        "DURATION": float(os.getenv("PROFILER_DURATION", 30)),
+        "INTERVAL": float(os.getenv("PROFILER_INTERVAL", 0.005)),
+        "PATH": os.getenv("PROFILER_PATH", "profiles"),
+    }
+
+    # Histograms for the duration of each stage and the batch sizes, served over HTTP
+    prometheus_config = {
+        "ENABLED": bool(os.getenv("USE_PROMETHEUS")),
+        "PORT": int(os.getenv("PROMETHEUS_PORT", 8000)),
+        # Workers under a supervisor write their metrics to shared files and the supervisor serves them
+        "SERVE": not os.getenv("PROMETHEUS_MULTIPROC_DIR"),
+    }
+
+    # Previous object documents are read in bulk for each batch, to avoid writing unchanged objects
+    object_reader_config = {
+        "CLASS": os.getenv("OBJECT_READER_CLASS", "magstats_step.readers.MongoObjectReader"),
+        "PARAMS": {
+            "host": os.getenv("MONGODB_HOST"),
+            "port": int(os.getenv("MONGODB_PORT", 27017)),
+            "username": os.getenv("MONGODB_USERNAME"),
+            "password": os.getenv("MONGODB_PASSWORD"),
+            "authSource": os.getenv("MONGODB_AUTH_SOURCE", "admin"),
+            "maxPoolSize": int(os.getenv("MONGODB_POOL_SIZE", 10)),
+        },
+        "DATABASE": os.getenv("MONGODB_DATABASE"),
+        "COLLECTION": "object",
+        "CACHE_SIZE": int(os.getenv("OBJECT_CACHE_SIZE", 100000)),
+    }
+
     if os.getenv("CONSUMER_KAFKA_USERNAME") and os.getenv("CONSUMER_KAFKA_PASSWORD"):
         consumer_config["PARAMS"]["security.protocol"] = "SASL_SSL"
         consumer_config["PARAMS"]["sasl.mechanism"] = "SCRAM-SHA-512"
@@ -96,6 +195,31 @@ def settings_factory():
         "LOGGING_DEBUG": logging_debug,
         "SCRIBE_PRODUCER_CONFIG": scribe_producer_config,
         "EXCLUDED_CALCULATORS": filter(bool, excluded_calculators),
+        "MAX_CHUNK_ROWS": max_chunk_rows,
+        "FAST_PATH_ROWS": fast_path_rows,
+        "MAGSTATS_WINDOWS": magstats_windows,
+        "HEALPIX_ORDERS": healpix_orders,
+        "CALCULATOR_THREADS": calculator_threads,
+        "SCRIBE_ENCODING": scribe_encoding,
+        "WARM_UP": warm_up,
+        "PROMETHEUS_CONFIG": prometheus_config,
     }
+    if os.getenv("USE_SCRIBE_FLOW_CONTROL"):
+        step_config["SCRIBE_FLOW_CONTROL"] = scribe_flow_control
+    if os.getenv("USE_MEMORY_PROFILING"):
+        step_config["MEMORY_PROFILING_CONFIG"] = memory_profiling_config
+    if deadline_config["BUDGET"]:
+        step_config["DEADLINE_CONFIG"] = deadline_config
+    if columnar_sink_config["PATH"]:
+        step_config["COLUMNAR_SINK_CONFIG"] = columnar_sink_config
+    if os.getenv("USE_COMPACT_METRICS"):
+        step_config["COMPACT_METRICS_CONFIG"] = compact_metrics_config
+    if os.getenv("USE_SAMPLING_PROFILER"):
+        step_config["SAMPLING_PROFILER_CONFIG"] = sampling_profiler_config
+    if os.getenv("USE_OBJECT_READER"):
+        step_config["OBJECT_READER_CONFIG"] = object_reader_config
+        step_config["SKIP_UNCHANGED"] = bool(os.getenv("SKIP_UNCHANGED_OBJECTS"))
+        if os.getenv("CACHE_SNAPSHOT_DIR"):
+            step_config["CACHE_SNAPSHOT_CONFIG"] = cache_snapshot_config
 
     return step_config
@@ -13,7 +13,7 @@ def env_variables():
         "METRICS_SERVER": "localhost",
         "METRICS_TOPIC": "metrics",
         "SCRIBE_PRODUCER_TOPIC": "w_something",
-        "SCRIBE_PRODUCER_CLASS": "unittest.mock.MagicMock",
+        "SCRIBE_PRODUCER_CLASS": "apf.core.step.DefaultProducer",
         "SCRIBE_PRODUCER_SERVER": "localhost",
         "PRODUCER_SERVER": "localhost",
     }
@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import magstats_step
+from magstats_step.step import MagstatsStep
+from magstats_step.synthetic import generate_messages
+from .data.messages import data
+
+messages = MagstatsStep.pre_execute(data)
+
+
+def test_calculate_statistics_from_records_gives_object_and_magnitude_frames():
+    stats, magstats = magstats_step.calculate_statistics(**messages)
+    assert stats.index.name == "aid"
+    assert magstats.index.names == ["aid", "sid", "fid"]
+    assert set(stats.index) == {msg["aid"] for msg in data}
+
+
+def test_calculate_statistics_from_frames_matches_records():
+    expected = magstats_step.calculate_statistics(**messages)
+    detections = pd.DataFrame.from_records(messages["detections"])
+    non_detections = pd.DataFrame.from_records(messages["non_detections"])
+    original = detections.copy()
+
+    stats, magstats = magstats_step.calculate_statistics(detections, non_detections)
+    assert_frame_equal(stats, expected[0])
+    assert_frame_equal(magstats, expected[1])
+    assert_frame_equal(detections, original)  # Input is left untouched
+
+
+def test_calculate_statistics_from_arrow_tables_matches_records():
+    pa = pytest.importorskip("pyarrow")
+    synthetic = MagstatsStep.pre_execute(generate_messages(20, seed=0))
+    expected = magstats_step.calculate_statistics(**synthetic)
+    detections = pd.DataFrame.from_records(synthetic["detections"]).drop(columns="extra_fields")
+    non_detections = pd.DataFrame.from_records(synthetic["non_detections"])
+
+    stats, magstats = magstats_step.calculate_statistics(
+        pa.Table.from_pandas(detections), pa.Table.from_pandas(non_detections)
+    )
+    assert_frame_equal(stats, expected[0])
+    assert_frame_equal(magstats, expected[1])
+
+
+def test_calculate_statistics_adds_sky_index_and_calls_release_hook():
+    released = []
+    stats, _ = magstats_step.calculate_statistics(**messages, healpix_orders=[4], on_release=released.append)
+    assert "healpix_4" in stats
+    assert [type(calculator).__name__ for calculator in released] == ["ObjectStatistics", "MagnitudeStatistics"]
+    assert all(calculator.cache_info()["entries"] == 0 for calculator in released)
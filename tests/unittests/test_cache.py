@@ -0,0 +1,90 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pandas as pd
+
+from magstats_step.core import MagnitudeStatistics
+from magstats_step.core._cache import IntermediateCache
+
+
+def test_cache_computes_each_key_only_once_and_counts_hits_and_misses():
+    cache = IntermediateCache()
+    compute = mock.Mock(return_value=1)
+
+    for _ in range(3):
+        assert cache.get("key", compute) == 1
+    compute.assert_called_once()
+    assert cache.info() == {"hits": 2, "misses": 1, "entries": 1, "nbytes": 0}
+
+
+def test_cache_never_evicts_entries_until_released():
+    cache = IntermediateCache()
+    for i in range(100):
+        cache.get(i, lambda: pd.Series([i]))
+    assert cache.info()["entries"] == 100
+    assert cache.nbytes == 100 * pd.Series([0]).memory_usage(deep=True)
+
+    cache.release()
+    assert cache.info()["entries"] == 0
+    assert cache.nbytes == 0
+
+
+def test_calculator_intermediates_are_reused_across_calculators_and_released():
+    detections = [
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 2, "candid": "a", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 2, "mag": 1, "candid": "b", "forced": False},
+    ]
+    calculator = MagnitudeStatistics(detections)
+    calculator.calculate_firstmjd()
+    calculator.calculate_lastmjd()
+
+    info = calculator.cache_info()
+    assert info["hits"] > 0
+    assert info["nbytes"] > 0
+
+    calculator.release()
+    assert calculator.cache_info()["entries"] == 0
+
+
+def test_cache_computes_each_key_only_once_across_threads():
+    cache = IntermediateCache()
+    calls = []
+
+    def compute():
+        calls.append(threading.get_ident())
+        time.sleep(0.01)  # Gives other threads the chance to request the same key meanwhile
+        return 1
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: cache.get("key", compute), range(32)))
+    assert results == [1] * 32
+    assert len(calls) == 1
+
+
+def test_cache_does_not_block_other_keys_while_computing_one():
+    cache = IntermediateCache()
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    with ThreadPoolExecutor(1) as executor:
+        pending = executor.submit(cache.get, "slow", slow)
+        started.wait(5)
+        assert cache.get("fast", lambda: "fast") == "fast"  # Would wait for the slow key with a single lock
+        assert not pending.done()
+        release.set()
+        assert pending.result() == "slow"
+
+
+def test_grouped_detections_are_built_before_being_shared():
+    detections = [
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 2, "candid": "a", "forced": False},
+        {"aid": "AID2", "sid": "SURVEY", "fid": 1, "mjd": 2, "mag": 1, "candid": "b", "forced": False},
+    ]
+    grouper = MagnitudeStatistics(detections)._grouped_detections().grouper
+    assert {"group_info", "result_index", "ngroups"} <= set(grouper._cache)
@@ -0,0 +1,122 @@
+import json
+from unittest import mock
+
+from magstats_step.deadline import DeadlinePlanner
+from scripts.run_step import step_factory
+from .data.messages import data
+
+
+def test_estimate_scales_with_rows_of_each_calculator():
+    planner = DeadlinePlanner({"BUDGET": 1, "COSTS": {"dmdt": 1.0, "ra": 0.5}})
+    assert planner.estimate(["dmdt"], detections=10, non_detections=2) == 2
+    assert planner.estimate(["ra", "ndet"], detections=10, non_detections=2) == 5 + 10 * planner.DEFAULT_COST
+
+
+def test_plan_defers_expensive_calculators_only_over_budget():
+    planner = DeadlinePlanner({"BUDGET": 1, "COSTS": {"ra": 0.01}})
+    calculators = {"ra", "dec", "ndet", "statistics"}
+    assert planner.plan(calculators, detections=10, non_detections=0) == set()
+    assert planner.plan(calculators, detections=1000, non_detections=0) == {"ra", "dec"}
+
+
+def deadline_step(monkeypatch, budget):
+    monkeypatch.setenv("SCRIBE_PRODUCER_CLASS", "magstats_step.inmemory.InMemoryProducer")
+    monkeypatch.setenv("DEADLINE_BUDGET", budget)
+    return step_factory()
+
+
+def produced(step):
+    return [json.loads(message["payload"])["data"] for message in step.scribe_producer.messages]
+
+
+def test_step_emits_fast_fields_first_and_deferred_fields_on_catch_up(env_variables, monkeypatch):
+    step = deadline_step(monkeypatch, "1e-9")
+    step.consumer = mock.MagicMock()
+    step.batch_start = 0  # The deadline has passed, nothing is caught up after the batch
+    step.post_execute(step.execute(step.pre_execute(data)))
+
+    fast = produced(step)
+    assert len(fast) == len(step.deferred) == len({msg["aid"] for msg in data})
+    for stats in fast:
+        assert "ndet" in stats and "firstmjd" in stats and "meanra" not in stats and "loc" not in stats
+        assert all("dmdt_first" in magstats and "magmean" in magstats for magstats in stats["magstats"])
+
+    step.tear_down()
+    assert not step.deferred
+    for stats in produced(step)[len(fast) :]:
+        assert "meanra" in stats and "loc" in stats
+        assert all("dmdt_first" in magstats for magstats in stats["magstats"])
+
+
+def test_step_never_defers_magnitude_statistics(env_variables, monkeypatch):
+    monkeypatch.setenv("DEADLINE_EXPENSIVE", "dmdt,ra")
+    step = deadline_step(monkeypatch, "1e-9")
+    assert step.defer(step.pre_execute(data)) == {"ra"}
+
+
+def test_step_drops_deferred_objects_seen_again(env_variables, monkeypatch):
+    step = deadline_step(monkeypatch, "1e-9")
+    step.batch_start = 0
+    step.post_execute(step.execute(step.pre_execute(data)))
+    step.deadline.budget = 1e9  # Next batch is within budget, so it is computed in full
+    step.execute(step.pre_execute(data[:1]))
+
+    assert data[0]["aid"] not in step.deferred
+    assert len(step.deferred) == len({msg["aid"] for msg in data[1:]} - {data[0]["aid"]})
+
+
+def test_step_computes_everything_within_budget(env_variables, monkeypatch):
+    step = deadline_step(monkeypatch, "1e9")
+    step.batch_start = 0
+    step.post_execute(step.execute(step.pre_execute(data)))
+
+    assert not step.deferred
+    assert all("meanra" in stats for stats in produced(step))
+
+
+def test_step_holds_back_commits_while_statistics_are_deferred(env_variables, monkeypatch):
+    step = deadline_step(monkeypatch, "1e-9")
+    step.consumer = mock.MagicMock()
+    step.metrics_sender = mock.MagicMock()
+    messages = step._pre_execute(data)
+    step.batch_start = 0
+    step._post_execute(step.execute(messages))
+    step.consumer.commit.assert_not_called()  # Deferred objects are only in memory, a restart must consume them again
+
+    step.deadline.budget = float("inf")  # Next batch is within budget and everything is caught up after it
+    step._post_execute(step.execute(step._pre_execute(data[:1])))
+    assert not step.deferred
+    step.consumer.commit.assert_called_once()
+
+
+def test_step_commits_deferred_batches_once_caught_up_on_tear_down(env_variables, monkeypatch):
+    step = deadline_step(monkeypatch, "1e-9")
+    step.consumer = mock.MagicMock()
+    step.metrics_sender = mock.MagicMock()
+    messages = step._pre_execute(data)
+    step.batch_start = 0
+    step._post_execute(step.execute(messages))
+    step.tear_down()
+    assert not step.deferred
+    step.consumer.commit.assert_called_once()
+
+
+def test_step_catches_up_with_everything_once_commits_were_held_for_too_long(env_variables, monkeypatch):
+    monkeypatch.setenv("DEADLINE_MAX_HELD_BATCHES", "2")
+    step = deadline_step(monkeypatch, "1e-9")
+    step.consumer = mock.MagicMock()
+    step.metrics_sender = mock.MagicMock()
+    for batch in range(3):
+        messages = step._pre_execute(data)
+        step.batch_start = 0  # Every batch overruns its budget
+        step._post_execute(step.execute(messages))
+        assert step.consumer.commit.call_count == (batch == 2)
+    assert not step.deferred and step.held_batches == 0
+
+
+def test_step_does_not_defer_while_backlog_is_full(env_variables, monkeypatch):
+    monkeypatch.setenv("DEADLINE_MAX_DEFERRED", "1")
+    step = deadline_step(monkeypatch, "1e-9")
+    step.deferred["AID"] = ([], [])
+    assert step.defer(step.pre_execute(data)) == set()
+    assert list(step.deferred) == ["AID"]
@@ -0,0 +1,98 @@
+import os
+from unittest import mock
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics
+from magstats_step.export import ColumnarSink
+from magstats_step.step import MagstatsStep
+from scripts.run_step import step_factory
+from .data.messages import data
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+@pytest.fixture
+def frames():
+    messages = MagstatsStep.pre_execute(data)
+    stats = ObjectStatistics(messages["detections"]).generate_statistics()
+    magstats = MagnitudeStatistics(**messages).generate_statistics()
+    return stats, magstats
+
+
+def files(path):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+
+def test_sink_writes_frames_partitioned_by_date_and_aid_prefix(tmp_path, frames):
+    stats, magstats = frames
+    sink = ColumnarSink({"PATH": str(tmp_path), "AID_PREFIX_LENGTH": 3})
+    sink.write(stats, magstats)
+    assert all(os.path.basename(path).startswith("_") for path in files(tmp_path))  # Still being written
+    sink.close()
+
+    for path in files(tmp_path):
+        table, date, prefix, name = os.path.relpath(path, tmp_path).split(os.sep)
+        assert date == f"date={sink.date}" and name.endswith(".parquet") and not name.startswith("_")
+        aids = pq.read_table(path).column("aid").to_pylist()
+        assert all(aid.startswith(prefix.removeprefix("prefix=")) for aid in aids)
+
+    result = pq.read_table(tmp_path / "magstats", partitioning=None).to_pandas().set_index(["aid", "sid", "fid"])
+    assert_frame_equal(result.sort_index(), magstats.sort_index(), check_like=True)
+
+
+def test_sink_rolls_over_files_by_rows(tmp_path, frames):
+    stats, magstats = frames
+    sink = ColumnarSink({"PATH": str(tmp_path), "AID_PREFIX_LENGTH": 0, "ROLLOVER_ROWS": len(stats)})
+    for _ in range(3):
+        sink.write(stats, magstats)
+    sink.close()
+    assert len(files(tmp_path / "object")) == 3
+
+
+def test_sink_compacts_small_files(tmp_path, frames):
+    stats, magstats = frames
+    sink = ColumnarSink({"PATH": str(tmp_path), "FORMAT": "arrow", "AID_PREFIX_LENGTH": 0, "COMPACT_FILES": 3})
+    for _ in range(3):
+        sink.write(stats, magstats)
+        sink.close()
+    assert len(files(tmp_path / "object")) == 3
+
+    sink.compact(sink.date)
+    (path,) = files(tmp_path / "object")
+    assert path.endswith(".arrow")
+    assert sink._read(path).num_rows == 3 * len(stats)
+
+
+def test_step_writes_statistics_to_sink(env_variables, monkeypatch, tmp_path):
+    monkeypatch.setenv("COLUMNAR_SINK_PATH", str(tmp_path))
+    step = step_factory()
+    result = step.execute(step.pre_execute(data))
+    step.tear_down()
+
+    aids = pq.read_table(tmp_path / "object", partitioning=None).column("aid").to_pylist()
+    assert sorted(aids) == sorted(result)
+
+
+def test_step_does_not_write_warm_up_to_sink(env_variables, monkeypatch, tmp_path):
+    monkeypatch.setenv("COLUMNAR_SINK_PATH", str(tmp_path))
+    step = step_factory()
+    step.warm_up()
+    step.tear_down()
+    assert not files(tmp_path)
+
+
+def test_step_writes_deferred_objects_to_sink_once_caught_up(env_variables, monkeypatch, tmp_path):
+    monkeypatch.setenv("COLUMNAR_SINK_PATH", str(tmp_path))
+    monkeypatch.setenv("DEADLINE_BUDGET", "0.000001")  # Every batch defers its expensive calculators
+    step = step_factory()
+    result = step.execute(step.pre_execute(data))
+    assert not files(tmp_path)  # Held back until complete
+
+    step.scribe_producer = mock.MagicMock()
+    step.tear_down()  # Catches up with the deferred objects
+    assert step.scribe_producer.produce.call_count == len(result)
+    table = pq.read_table(tmp_path / "object", partitioning=None)
+    assert sorted(table.column("aid").to_pylist()) == sorted(result)
+    assert "meanra" in table.column_names and table.column("meanra").null_count == 0
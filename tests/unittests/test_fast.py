@@ -0,0 +1,95 @@
+import copy
+import random
+from unittest import mock
+
+import pytest
+
+from magstats_step.core import calculate_records, calculate_statistics
+from magstats_step.step import MagstatsStep
+from magstats_step.synthetic import generate_messages
+from scripts.run_step import step_factory
+from .data.messages import data
+
+
+def assert_same(result, expected):
+    # Identical up to float rounding, as sums are accumulated in a different order
+    if isinstance(expected, dict):
+        assert result.keys() == expected.keys()
+        for key in expected:
+            assert_same(result[key], expected[key])
+    elif isinstance(expected, list):
+        assert len(result) == len(expected)
+        for left, right in zip(result, expected):
+            assert_same(left, right)
+    elif isinstance(expected, float):
+        assert result == pytest.approx(expected, rel=1e-9, abs=1e-12)
+    else:
+        assert result == expected
+
+
+def with_edge_cases(messages):
+    # Missing magnitudes, ties in dates, forced and uncorrected detections and saturated magnitudes
+    rng = random.Random(3)
+    messages = copy.deepcopy(messages)
+    for message in messages:
+        for detection in message["detections"]:
+            value = rng.random()
+            if value < 0.1:
+                detection["mag"] = None
+            elif value < 0.2:
+                detection["mjd"] = round(detection["mjd"])
+            elif value < 0.25:
+                detection["forced"] = True
+            elif value < 0.3 and detection["corrected"]:
+                detection["mag_corr"] = 12.0
+            if rng.random() < 0.2:
+                detection["corrected"] = False
+    return messages
+
+
+def all_forced(messages):
+    messages = copy.deepcopy(messages)
+    for message in messages:
+        for detection in message["detections"]:
+            detection["forced"] = True
+    return messages
+
+
+@pytest.mark.parametrize(
+    "messages",
+    [data, generate_messages(100, seed=1), with_edge_cases(generate_messages(100, seed=2)), all_forced(data)],
+    ids=["test data", "synthetic", "edge cases", "all forced"],
+)
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"windows": [0.5, 7], "healpix_orders": [4, 10]}, {"exclude": {"ra", "calculate_dmdt", "statistics"}}],
+    ids=["default", "windows and healpix", "excluded"],
+)
+def test_calculate_records_matches_assembled_frames(messages, kwargs):
+    messages = MagstatsStep.pre_execute(messages)
+    expected = MagstatsStep.assemble(*calculate_statistics(**messages, **kwargs))
+    assert_same(calculate_records(**messages, **kwargs), expected)
+
+
+def test_calculate_records_without_detections_gives_no_objects():
+    assert calculate_records([], [], windows=[1.0], healpix_orders=[4]) == {}
+
+
+def test_step_uses_fast_path_only_for_small_batches(env_variables):
+    step = step_factory()
+    step.fast_path_rows = 100
+    messages = MagstatsStep.pre_execute(generate_messages(3, seed=0))
+    with mock.patch("magstats_step.step.calculate_statistics", wraps=calculate_statistics) as frames:
+        small = step.execute(messages)
+        frames.assert_not_called()
+        step.fast_path_rows = 10
+        assert_same(small, step.execute(messages))
+        frames.assert_called_once()
+
+
+def test_step_never_uses_fast_path_when_disabled(env_variables):
+    step = step_factory()
+    assert step.fast_path_rows == 0
+    with mock.patch("magstats_step.step.calculate_records") as records:
+        step.execute(MagstatsStep.pre_execute(generate_messages(1, seed=0)))
+    records.assert_not_called()
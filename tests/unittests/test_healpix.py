@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from magstats_step.core.healpix import ang2pix_nested, sky_index
+from scripts.run_step import step_factory
+from .data.messages import data
+
+ra = np.array([10.5, 200.0, 359.0, 45.0, 120.0, 300.0])
+dec = np.array([5.0, 60.0, -75.0, 89.9, -30.0, 45.0])
+
+
+# Expected values computed with healpy.ang2pix(2 ** order, ra, dec, nest=True, lonlat=True)
+@pytest.mark.parametrize(
+    "order,expected",
+    [
+        (0, [4, 2, 11, 0, 9, 3]),
+        (3, [283, 184, 708, 63, 621, 231]),
+        (10, [4646350, 3025087, 11603983, 1048572, 10181017, 3792896]),
+        (20, [4872051353925, 3172034198098, 12167658963170, 1099508466687, 10675570710937, 3977139722648]),
+    ],
+)
+def test_ang2pix_nested_matches_healpix_reference(order, expected):
+    assert ang2pix_nested(order, ra, dec).tolist() == expected
+
+
+def test_ang2pix_nested_pixels_are_contained_in_parent_pixels():
+    rng = np.random.default_rng(0)
+    ra, dec = rng.uniform(0, 360, 1000), np.degrees(np.arcsin(rng.uniform(-1, 1, 1000)))
+    np.testing.assert_array_equal(ang2pix_nested(12, ra, dec) >> 4, ang2pix_nested(10, ra, dec))
+
+
+def test_sky_index_leaves_missing_coordinates_empty():
+    index = pd.Index(["AID1", "AID2"], name="aid")
+    result = sky_index(pd.Series([10.5, np.nan], index=index), pd.Series([5.0, 1.0], index=index), [0, 3])
+    assert result.columns.tolist() == ["healpix_0", "healpix_3"]
+    assert result.loc["AID1"].tolist() == [4, 283]
+    assert result.loc["AID2"].isna().all()
+
+
+def test_step_emits_sky_index_in_object_document(env_variables, monkeypatch):
+    monkeypatch.setenv("HEALPIX_ORDERS", "5,10")
+    step = step_factory()
+    result = step.execute(step.pre_execute(data))
+    for stats in result.values():
+        assert stats["healpix_10"] >> 10 == stats["healpix_5"]
+        assert stats["healpix_5"] == ang2pix_nested(5, stats["meanra"], stats["meandec"])[0]
@@ -0,0 +1,35 @@
+from apf.core import get_class
+
+from magstats_step.inmemory import InMemoryConsumer, InMemoryProducer
+from magstats_step.scribe import JsonPayloadEncoder
+from magstats_step.step import MagstatsStep
+
+
+def test_in_memory_classes_are_loadable_by_apf():
+    assert get_class("magstats_step.inmemory.InMemoryConsumer") is InMemoryConsumer
+    assert get_class("magstats_step.inmemory.InMemoryProducer") is InMemoryProducer
+
+
+def test_in_memory_consumer_yields_batches():
+    consumer = InMemoryConsumer({"N_MESSAGES": 25, "BATCH_SIZE": 10})
+    assert [len(batch) for batch in consumer.consume()] == [10, 10, 5]
+
+
+def test_step_runs_end_to_end_in_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # The step writes a __SUCCESS__ file when it finishes
+    config = {
+        "CONSUMER_CONFIG": {"CLASS": "magstats_step.inmemory.InMemoryConsumer", "N_MESSAGES": 50, "BATCH_SIZE": 20},
+        "SCRIBE_PRODUCER_CONFIG": {"CLASS": "magstats_step.inmemory.InMemoryProducer"},
+        "EXCLUDED_CALCULATORS": [],
+    }
+    step = MagstatsStep(config=config)
+    step.start()
+
+    report = step.consumer.report(elapsed=1)
+    assert report["messages"] == 50 and report["batches"] == 3
+    assert report["detections_per_second"] == 500
+    assert report["p50_batch_latency"] <= report["p99_batch_latency"]
+
+    aids = {msg["aid"] for msg in step.consumer.messages}
+    produced = [JsonPayloadEncoder().decode(message)["criteria"]["_id"] for message in step.scribe_producer.messages]
+    assert sorted(produced) == sorted(aids)
@@ -1,9 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import numpy as np
 import pandas as pd
-from pandas.testing import assert_frame_equal
+from pandas.testing import assert_frame_equal, assert_series_equal
 from magstats_step.core import MagnitudeStatistics
+from magstats_step.synthetic import generate_messages
 
 
 def test_calculate_uncorrected_stats_gives_statistics_for_magnitudes_per_aid_and_fid():
@@ -67,7 +69,15 @@ def test_calculate_uncorrected_stats_over_time_gives_first_and_last_magnitude_pe
         {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 3, "mag": 1, "candid": "a", "forced": False},  # last
         {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 2, "candid": "b", "forced": False},  # first
         {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 2, "mag": 3, "candid": "c", "forced": False},
-        {"aid": "AID2", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 1, "candid": "d", "forced": False},  # last and first
+        {
+            "aid": "AID2",
+            "sid": "SURVEY",
+            "fid": 1,
+            "mjd": 1,
+            "mag": 1,
+            "candid": "d",
+            "forced": False,
+        },  # last and first
         {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 1, "mag": 1, "candid": "e", "forced": False},  # first
         {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 2, "mag": 2, "candid": "f", "forced": False},  # last
     ]
@@ -88,14 +98,86 @@ def test_calculate_uncorrected_stats_over_time_gives_first_and_last_magnitude_pe
 
 def test_calculate_corrected_stats_over_time_gives_first_and_last_corrected_magnitude_per_aid_and_fid():
     detections = [
-        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 3, "mag_corr": 1, "corrected": True, "candid": "a", "forced": False},
-        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag_corr": 2, "corrected": True, "candid": "b", "forced": False},
-        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 2, "mag_corr": 3, "corrected": True, "candid": "c", "forced": False},
-        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 4, "mag_corr": 3, "corrected": False, "candid": "c1", "forced": False},
-        {"aid": "AID2", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag_corr": 1, "corrected": True, "candid": "d", "forced": False},
-        {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 1, "mag_corr": 1, "corrected": True, "candid": "e", "forced": False},
-        {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 2, "mag_corr": 2, "corrected": True, "candid": "f", "forced": False},
-        {"aid": "AID2", "sid": "SURVEY", "fid": 2, "mjd": 0, "mag_corr": 2, "corrected": False, "candid": "f1", "forced": False},
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 1,
+            "mjd": 3,
+            "mag_corr": 1,
+            "corrected": True,
+            "candid": "a",
+            "forced": False,
+        },
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 1,
+            "mjd": 1,
+            "mag_corr": 2,
+            "corrected": True,
+            "candid": "b",
+            "forced": False,
+        },
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 1,
+            "mjd": 2,
+            "mag_corr": 3,
+            "corrected": True,
+            "candid": "c",
+            "forced": False,
+        },
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 1,
+            "mjd": 4,
+            "mag_corr": 3,
+            "corrected": False,
+            "candid": "c1",
+            "forced": False,
+        },
+        {
+            "aid": "AID2",
+            "sid": "SURVEY",
+            "fid": 1,
+            "mjd": 1,
+            "mag_corr": 1,
+            "corrected": True,
+            "candid": "d",
+            "forced": False,
+        },
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 2,
+            "mjd": 1,
+            "mag_corr": 1,
+            "corrected": True,
+            "candid": "e",
+            "forced": False,
+        },
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 2,
+            "mjd": 2,
+            "mag_corr": 2,
+            "corrected": True,
+            "candid": "f",
+            "forced": False,
+        },
+        {
+            "aid": "AID2",
+            "sid": "SURVEY",
+            "fid": 2,
+            "mjd": 0,
+            "mag_corr": 2,
+            "corrected": False,
+            "candid": "f1",
+            "forced": False,
+        },
     ]
     calculator = MagnitudeStatistics(detections)
     result = calculator._calculate_stats_over_time(True)
@@ -143,7 +225,7 @@ def test_calculate_firstmjd_gives_first_date_per_aid_and_fid():
             "firstmjd": [0, 0.5, 1],
             "aid": ["AID1", "AID2", "AID1"],
             "sid": ["SURVEY", "SURVEY", "SURVEY"],
-            "fid": [1, 1, 2]
+            "fid": [1, 1, 2],
         }
     )
     assert_frame_equal(result, expected.set_index(["aid", "sid", "fid"]), check_like=True)
@@ -162,12 +244,7 @@ def test_calculate_lastmjd_gives_last_date_per_aid_and_fid():
     result = calculator.calculate_lastmjd()
 
     expected = pd.DataFrame(
-        {
-            "lastmjd": [3, 1, 2],
-            "aid": ["AID1", "AID2", "AID1"],
-            "sid": ["SURVEY", "SURVEY", "SURVEY"],
-            "fid": [1, 1, 2]
-        }
+        {"lastmjd": [3, 1, 2], "aid": ["AID1", "AID2", "AID1"], "sid": ["SURVEY", "SURVEY", "SURVEY"], "fid": [1, 1, 2]}
     )
     assert_frame_equal(result, expected.set_index(["aid", "sid", "fid"]), check_like=True)
 
@@ -231,12 +308,7 @@ def test_calculate_ndet_gives_number_of_detections_per_aid_and_fid():
     result = calculator.calculate_ndet()
 
     expected = pd.DataFrame(
-        {
-            "ndet": [3, 1, 2],
-            "aid": ["AID1", "AID2", "AID1"],
-            "sid": ["SURVEY", "SURVEY", "SURVEY"],
-            "fid": [1, 1, 2]
-        }
+        {"ndet": [3, 1, 2], "aid": ["AID1", "AID2", "AID1"], "sid": ["SURVEY", "SURVEY", "SURVEY"], "fid": [1, 1, 2]}
     )
     assert_frame_equal(result, expected.set_index(["aid", "sid", "fid"]), check_like=True)
 
@@ -258,7 +330,7 @@ def test_calculate_ndubious_gives_number_of_dubious_detections_per_aid_and_fid()
             "ndubious": [2, 0, 1],
             "aid": ["AID1", "AID2", "AID1"],
             "sid": ["SURVEY", "SURVEY", "SURVEY"],
-            "fid": [1, 1, 2]
+            "fid": [1, 1, 2],
         }
     )
     assert_frame_equal(result, expected.set_index(["aid", "sid", "fid"]), check_like=True)
@@ -271,11 +343,43 @@ def test_calculate_saturation_rate_gives_saturation_ratio_per_aid_and_fid():
         {"aid": "AID1", "sid": "ZTF", "fid": 1, "corrected": True, "mag_corr": 100, "candid": "c", "forced": False},
         {"aid": "AID1", "sid": "ZTF", "fid": 1, "corrected": True, "mag_corr": 0, "candid": "c1", "forced": False},
         {"aid": "AID2", "sid": "ZTF", "fid": 2, "corrected": False, "mag_corr": np.nan, "candid": "d", "forced": False},
-        {"aid": "AID2", "sid": "ZTF", "fid": 3, "corrected": False, "mag_corr": np.nan, "candid": "d1", "forced": False},
+        {
+            "aid": "AID2",
+            "sid": "ZTF",
+            "fid": 3,
+            "corrected": False,
+            "mag_corr": np.nan,
+            "candid": "d1",
+            "forced": False,
+        },
         {"aid": "AID2", "sid": "ZTF", "fid": 3, "corrected": True, "mag_corr": 100, "candid": "d2", "forced": False},
-        {"aid": "AID1", "sid": "SURVEY", "fid": 10, "corrected": True, "mag_corr": 0, "candid": "e", "forced": False},  # No threshold
-        {"aid": "AID1", "sid": "SURVEY", "fid": 10, "corrected": True, "mag_corr": 100, "candid": "f", "forced": False},  # No threshold
-        {"aid": "AID3", "sid": "SURVEY", "fid": 1, "corrected": False, "mag_corr": 0, "candid": "g", "forced": False},  # No threshold
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 10,
+            "corrected": True,
+            "mag_corr": 0,
+            "candid": "e",
+            "forced": False,
+        },  # No threshold
+        {
+            "aid": "AID1",
+            "sid": "SURVEY",
+            "fid": 10,
+            "corrected": True,
+            "mag_corr": 100,
+            "candid": "f",
+            "forced": False,
+        },  # No threshold
+        {
+            "aid": "AID3",
+            "sid": "SURVEY",
+            "fid": 1,
+            "corrected": False,
+            "mag_corr": 0,
+            "candid": "g",
+            "forced": False,
+        },  # No threshold
     ]
     calculator = MagnitudeStatistics(detections)
     result = calculator.calculate_saturation_rate()
@@ -292,7 +396,97 @@ def test_calculate_saturation_rate_gives_saturation_ratio_per_aid_and_fid():
 
 
 def test_magnitude_statistics_ignores_forced_photometry():
-    detections = [{"candid": "a", "forced": False}, {"candid": "b", "forced": True}]
+    detections = [{"candid": "a", "mag": 1, "forced": False}, {"candid": "b", "mag": 2, "forced": True}]
+    calculator = MagnitudeStatistics(detections)
+
+    assert_frame_equal(calculator._detections, pd.DataFrame({"mag": [1]}, index=pd.Index(["a"], name="candid")))
+
+
+def test_grouped_value_with_ties_in_date_keeps_first_detection_in_input_order():
+    detections = [
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 2, "mag": 1, "candid": "a", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 2, "candid": "b", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 2, "mag": 3, "candid": "c", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 4, "candid": "d", "forced": False},
+    ]
     calculator = MagnitudeStatistics(detections)
 
-    assert_frame_equal(calculator._detections, pd.DataFrame({"forced": False}, index=pd.Index(["a"], name="candid")))
+    index = pd.MultiIndex.from_tuples([("AID1", "SURVEY", 1)], names=["aid", "sid", "fid"])
+    assert_series_equal(calculator._grouped_value("mag", which="first"), pd.Series([2], index=index, name="mag"))
+    assert_series_equal(calculator._grouped_value("mag", which="last"), pd.Series([1], index=index, name="mag"))
+
+
+def test_calculate_windowed_gives_statistics_for_last_days_per_aid_and_fid():
+    detections = [
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 5, "candid": "a", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 8, "mag": 3, "candid": "b", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 10, "mag": 1, "candid": "c", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 2, "mag": 2, "candid": "d", "forced": False},
+        {"aid": "AID2", "sid": "SURVEY", "fid": 1, "mjd": 30, "mag": np.nan, "candid": "e", "forced": False},
+        {"aid": "AID2", "sid": "SURVEY", "fid": 1, "mjd": 20, "mag": 4, "candid": "f", "forced": False},
+    ]
+    calculator = MagnitudeStatistics(detections, windows=[2, 10.5])
+    result = calculator.calculate_windowed()
+
+    expected = pd.DataFrame(
+        {
+            "ndet_2d": [2, 0, 1],
+            "magmean_2d": [2, np.nan, np.nan],
+            "magmin_2d": [1, np.nan, np.nan],
+            "magmax_2d": [3, np.nan, np.nan],
+            "ndet_10.5d": [3, 1, 2],
+            "magmean_10.5d": [3, 2, 4],
+            "magmin_10.5d": [1, 2, 4],
+            "magmax_10.5d": [5, 2, 4],
+            "aid": ["AID1", "AID1", "AID2"],
+            "sid": ["SURVEY", "SURVEY", "SURVEY"],
+            "fid": [1, 2, 1],
+        }
+    )
+    assert_frame_equal(result, expected.set_index(["aid", "sid", "fid"]), check_like=True, check_dtype=False)
+
+
+def test_calculate_windowed_leaves_bands_without_recent_detections_empty():
+    detections = [
+        {"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1000, "mag": 5, "candid": "a", "forced": False},
+        {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 1, "mag": 2, "candid": "b", "forced": False},  # Stale
+        {"aid": "AID1", "sid": "SURVEY", "fid": 2, "mjd": 2, "mag": 3, "candid": "c", "forced": False},  # Stale
+        {"aid": "AID2", "sid": "SURVEY", "fid": 2, "mjd": 2, "mag": 4, "candid": "d", "forced": False},
+    ]
+    result = MagnitudeStatistics(detections, windows=[7]).calculate_windowed()
+
+    expected = pd.DataFrame(
+        {
+            "ndet_7d": [1, 0, 1],
+            "magmean_7d": [5, np.nan, 4],
+            "magmin_7d": [5, np.nan, 4],
+            "magmax_7d": [5, np.nan, 4],
+            "aid": ["AID1", "AID1", "AID2"],
+            "sid": ["SURVEY", "SURVEY", "SURVEY"],
+            "fid": [1, 2, 2],
+        }
+    )
+    assert_frame_equal(result, expected.set_index(["aid", "sid", "fid"]), check_like=True, check_dtype=False)
+
+
+def test_calculate_windowed_with_only_forced_photometry_gives_empty_frame():
+    detections = [{"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 5, "candid": "a", "forced": True}]
+    result = MagnitudeStatistics(detections, windows=[7]).calculate_windowed()
+    assert result.empty
+
+
+def test_calculate_windowed_without_windows_gives_no_columns():
+    detections = [{"aid": "AID1", "sid": "SURVEY", "fid": 1, "mjd": 1, "mag": 5, "candid": "a", "forced": False}]
+    result = MagnitudeStatistics(detections).calculate_windowed()
+    assert result.columns.empty
+    assert list(result.index) == [("AID1", "SURVEY", 1)]
+
+
+def test_generate_statistics_with_executor_matches_sequential_including_column_order():
+    messages = generate_messages(20, seed=1)
+    detections = [det for msg in messages for det in msg["detections"]]
+    non_detections = [nd for msg in messages for nd in msg["non_detections"]]
+    expected = MagnitudeStatistics(detections, non_detections).generate_statistics()
+    with ThreadPoolExecutor(4) as executor:
+        result = MagnitudeStatistics(detections, non_detections).generate_statistics(executor=executor)
+    assert_frame_equal(result, expected)
@@ -0,0 +1,36 @@
+from prometheus_client import CollectorRegistry
+
+from magstats_step.metrics import PrometheusStageMetrics
+
+
+def test_time_stage_observes_duration_for_stage():
+    registry = CollectorRegistry()
+    metrics = PrometheusStageMetrics(registry)
+    with metrics.time_stage("pre_execute"):
+        pass
+
+    assert registry.get_sample_value("magstats_stage_duration_seconds_count", {"stage": "pre_execute"}) == 1
+
+
+def test_time_calculator_observes_duration_even_if_calculator_fails():
+    registry = CollectorRegistry()
+    metrics = PrometheusStageMetrics(registry)
+    try:
+        with metrics.time_calculator("ObjectStatistics"):
+            raise ValueError
+    except ValueError:
+        pass
+
+    labels = {"calculator": "ObjectStatistics"}
+    assert registry.get_sample_value("magstats_calculator_duration_seconds_count", labels) == 1
+
+
+def test_observe_batch_records_each_kind_of_size():
+    registry = CollectorRegistry()
+    metrics = PrometheusStageMetrics(registry)
+    metrics.observe_batch(messages=10, detections=100, non_detections=50, aids=8)
+
+    assert registry.get_sample_value("magstats_batch_size_sum", {"kind": "messages"}) == 10
+    assert registry.get_sample_value("magstats_batch_size_sum", {"kind": "detections"}) == 100
+    assert registry.get_sample_value("magstats_batch_size_sum", {"kind": "non_detections"}) == 50
+    assert registry.get_sample_value("magstats_batch_size_sum", {"kind": "aids"}) == 8
@@ -155,21 +155,21 @@ def test_calculate_coordinates_with_dec_uses_weighted_mean_and_weighted_mean_err
 
 def test_calculate_unique_gives_list_of_unique_values_in_field_per_aid():
     detections = [
-        {"aid": "AID1", "candid": "a", "extra": "A", "forced": False},
-        {"aid": "AID2", "candid": "c", "extra": "A", "forced": False},
-        {"aid": "AID1", "candid": "b", "extra": "A", "forced": False},
-        {"aid": "AID1", "candid": "d", "extra": "B", "forced": False},
+        {"aid": "AID1", "candid": "a", "oid": "A", "forced": False},
+        {"aid": "AID2", "candid": "c", "oid": "A", "forced": False},
+        {"aid": "AID1", "candid": "b", "oid": "A", "forced": False},
+        {"aid": "AID1", "candid": "d", "oid": "B", "forced": False},
     ]
     calculator = ObjectStatistics(detections)
-    result = calculator._calculate_unique("extra")
+    result = calculator._calculate_unique("oid")
 
-    assert "extra" in result
+    assert "oid" in result
     assert_series_equal(
-        result["extra"],
+        result["oid"],
         pd.Series(
             [["A", "B"], ["A"]],
             index=pd.Index(["AID1", "AID2"], name="aid"),
-            name="extra",
+            name="oid",
         ),
     )
 
@@ -310,7 +310,17 @@ def test_calculate_stellar_gives_whether_first_detection_in_surveys_with_stellar
 
 
 def test_object_statistics_ignores_forced_photometry():
-    detections = [{"candid": "a", "check": "this", "forced": False}, {"candid": "b", "check": "that", "forced": True}]
+    detections = [{"candid": "a", "oid": "this", "forced": False}, {"candid": "b", "oid": "that", "forced": True}]
     calculator = ObjectStatistics(detections)
 
-    assert_series_equal(calculator._detections["check"], pd.Series(["this"], index=pd.Index(["a"], name="candid"), name="check"))
+    assert_series_equal(calculator._detections["oid"], pd.Series(["this"], index=pd.Index(["a"], name="candid"), name="oid"))
+
+
+def test_object_statistics_only_ingests_columns_of_enabled_calculators():
+    detections = [{"aid": "AID1", "sid": "S", "candid": "a", "mjd": 1, "oid": "A", "pid": 1, "forced": False}]
+    assert set(ObjectStatistics(detections)._detections.columns) == {"aid", "sid", "mjd", "oid"}
+
+    exclude = set(ObjectStatistics.calculators()) - {"ndet", "firstmjd"}
+    calculator = ObjectStatistics(detections, exclude=exclude)
+    assert set(calculator._detections.columns) == {"aid", "sid", "mjd"}
+    assert list(calculator.generate_statistics().columns) == ["firstmjd", "ndet"]
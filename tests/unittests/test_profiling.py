@@ -0,0 +1,110 @@
+import logging
+import os
+import signal
+import time
+import tracemalloc
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics
+from magstats_step.metrics import PrometheusStageMetrics
+from magstats_step.profiling import MemoryProfiler, SamplingProfiler
+from magstats_step.step import MagstatsStep
+from scripts.run_step import step_factory
+from .data.messages import data
+
+
+def test_memory_usage_includes_frames_and_cache():
+    messages = MagstatsStep.pre_execute(data)
+    calculator = MagnitudeStatistics(**messages)
+    assert calculator.memory_usage()["cache"] == 0
+    calculator.generate_statistics()
+
+    usage = calculator.memory_usage()
+    assert usage["detections"] > 0 and usage["non_detections"] > 0 and usage["cache"] > 0
+    assert "non_detections" not in ObjectStatistics(messages["detections"]).memory_usage()
+
+
+def test_memory_profiler_reports_largest_usage_in_batch_and_rss_high_water():
+    registry = CollectorRegistry()
+    profiler = MemoryProfiler({"TRACEMALLOC_EVERY": 0}, PrometheusStageMetrics(registry))
+    messages = MagstatsStep.pre_execute(data)
+    profiler.start_batch()
+    profiler.observe_calculator(ObjectStatistics(messages["detections"]))
+    profiler.observe_calculator(ObjectStatistics(messages["detections"][:1]))
+    usage = profiler.end_batch()
+
+    assert usage["ObjectStatistics.detections"] == ObjectStatistics(messages["detections"]).memory_usage()["detections"]
+    assert usage["rss_high_water"] > 0
+    assert registry.get_sample_value("magstats_memory_bytes", {"kind": "rss_high_water"}) == usage["rss_high_water"]
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="Peak RSS can only be reset on Linux")
+def test_memory_profiler_reports_rss_high_water_of_each_batch():
+    profiler = MemoryProfiler({"TRACEMALLOC_EVERY": 0})
+    profiler.start_batch()
+    block = b"x" * 2**28  # Written, so that it is resident
+    large = profiler.end_batch()["rss_high_water"]
+    del block
+
+    profiler.start_batch()
+    small = profiler.end_batch()["rss_high_water"]
+    assert small < large - 2**27
+
+
+def test_memory_profiler_traces_allocations_only_on_sampled_batches(caplog):
+    profiler = MemoryProfiler({"TRACEMALLOC_EVERY": 2, "TOP": 3})
+    logged = []
+    with caplog.at_level(logging.INFO):
+        for batch in range(3):
+            caplog.clear()
+            profiler.start_batch()
+            assert tracemalloc.is_tracing() == (batch % 2 == 0)
+            blocks = [bytes(100) for _ in range(100)]  # Allocations to trace
+            profiler.end_batch()
+            logged.append(sum("Top allocation" in record.message for record in caplog.records))
+            del blocks
+    assert not tracemalloc.is_tracing()
+    assert logged[1] == 0 and 1 <= logged[0] <= 3 and 1 <= logged[2] <= 3
+
+
+def test_step_reports_memory_when_profiling_is_enabled(env_variables, monkeypatch):
+    monkeypatch.setenv("USE_MEMORY_PROFILING", "yes")
+    monkeypatch.setenv("TRACEMALLOC_EVERY", "0")
+    step = step_factory()
+    step.message = data
+    step.post_execute(step.execute(step._pre_execute(data)))
+
+    assert step.memory_profiler.batches == 1
+    assert {"ObjectStatistics.cache", "MagnitudeStatistics.non_detections"} <= step.memory_profiler.usage.keys()
+
+
+def test_sampling_profiler_writes_collapsed_stacks_tagged_by_calculator(tmp_path):
+    profiler = SamplingProfiler({"PATH": str(tmp_path), "DURATION": 0.3, "INTERVAL": 0.001})
+    messages = MagstatsStep.pre_execute(data)
+    profiler.start()
+    end = time.monotonic() + 0.4
+    while time.monotonic() < end:
+        ObjectStatistics(messages["detections"]).generate_statistics()
+    profiler.wait()
+
+    (path,) = tmp_path.iterdir()
+    lines = path.read_text().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    tags = {line.split(";", 1)[0] for line in lines}
+    assert any(tag.startswith("ObjectStatistics.calculate_") for tag in tags)
+    assert all("sampling-profiler" not in line and "_run (profiling.py" not in line for line in lines)
+
+
+def test_sampling_profiler_starts_on_signal(tmp_path):
+    previous = signal.getsignal(signal.SIGUSR2)
+    try:
+        profiler = SamplingProfiler({"PATH": str(tmp_path), "DURATION": 0.05, "SIGNAL": "SIGUSR2"})
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert profiler.running
+        profiler.wait()
+    finally:
+        signal.signal(signal.SIGUSR2, previous)
+    assert len(list(tmp_path.iterdir())) == 1
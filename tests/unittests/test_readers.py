@@ -0,0 +1,46 @@
+from magstats_step.readers import InMemoryObjectReader
+
+
+def test_get_fetches_all_missing_documents_in_a_single_query():
+    reader = InMemoryObjectReader({"DOCUMENTS": [{"_id": "AID1", "ndet": 1}, {"_id": "AID2", "ndet": 2}]})
+    result = reader.get(["AID1", "AID2", "AID3", "AID1"])
+
+    assert result == {"AID1": {"_id": "AID1", "ndet": 1}, "AID2": {"_id": "AID2", "ndet": 2}}
+    assert reader.queries == 1
+
+
+def test_get_reads_cached_documents_without_querying():
+    reader = InMemoryObjectReader({"DOCUMENTS": [{"_id": "AID1", "ndet": 1}, {"_id": "AID2", "ndet": 2}]})
+    reader.get(["AID1", "AID2"])
+    result = reader.get(["AID2", "AID1"])
+
+    assert result == {"AID1": {"_id": "AID1", "ndet": 1}, "AID2": {"_id": "AID2", "ndet": 2}}
+    assert reader.queries == 1
+    assert reader.cache_info() == {"hits": 2, "misses": 2, "entries": 2}
+
+
+def test_cache_evicts_least_recently_used_documents_beyond_its_size():
+    documents = [{"_id": f"AID{i}"} for i in range(3)]
+    reader = InMemoryObjectReader({"DOCUMENTS": documents, "CACHE_SIZE": 2})
+    reader.get(["AID0", "AID1"])
+    reader.get(["AID0"])  # AID1 becomes the least recently used
+    reader.get(["AID2"])
+
+    assert reader.cache_info()["entries"] == 2
+    reader.get(["AID0", "AID2"])
+    assert reader.queries == 2
+    reader.get(["AID1"])
+    assert reader.queries == 3
+
+
+def test_update_merges_data_into_cached_document():
+    reader = InMemoryObjectReader({"DOCUMENTS": [{"_id": "AID1", "ndet": 1, "oid": ["OID1"]}]})
+    reader.get(["AID1"])
+    reader.update("AID1", {"ndet": 2})
+    reader.update("AID2", {"ndet": 1})
+
+    assert reader.get(["AID1", "AID2"]) == {
+        "AID1": {"_id": "AID1", "ndet": 2, "oid": ["OID1"]},
+        "AID2": {"_id": "AID2", "ndet": 1},
+    }
+    assert reader.queries == 1
@@ -0,0 +1,195 @@
+import io
+import json
+from unittest import mock
+
+import fastavro
+import pytest
+from apf.producers import GenericProducer, KafkaSchemalessProducer
+
+from magstats_step.core import MagnitudeStatistics, ObjectStatistics
+from magstats_step.metrics import StageMetrics
+from magstats_step.scribe import AvroPayloadEncoder, FlowControlledProducer, JsonPayloadEncoder
+from magstats_step.step import MagstatsStep
+from scripts.run_step import step_factory
+from .data.messages import data
+
+command = {
+    "collection": "object",
+    "type": "update",
+    "criteria": {"_id": "AID1"},
+    "data": {
+        "ndet": 2,
+        "meanra": 10.5,
+        "meandec": None,
+        "oid": ["OID1", "OID2"],
+        "corrected": True,
+        "loc": {"type": "Point", "coordinates": [-169.5, None]},
+        "unknown": 1.5,
+        "magstats": [{"sid": "ZTF", "fid": "g", "ndet": 2, "magmean": 15.0, "dmdt_first": None, "unknown": "a"}],
+    },
+    "options": {"upsert": True},
+}
+
+
+def test_json_encoder_dumps_command_into_payload():
+    encoder = JsonPayloadEncoder()
+    message = encoder.encode(command)
+
+    assert message == {"payload": json.dumps(command)}
+    assert encoder.decode(message) == command
+
+
+def test_avro_encoder_round_trip_keeps_typed_extra_and_absent_fields():
+    encoder = AvroPayloadEncoder()
+    message = encoder.encode(command)
+
+    assert message["schema_version"] == AvroPayloadEncoder.VERSION
+    assert isinstance(message["payload"], bytes)
+    assert encoder.decode(message) == command
+
+
+def test_avro_encoder_round_trip_with_step_output():
+    formatted = MagstatsStep.pre_execute(data)
+    stats = ObjectStatistics(formatted["detections"]).generate_statistics()
+    magstats = MagnitudeStatistics(**formatted).generate_statistics()
+    encoder = AvroPayloadEncoder()
+    for aid, obj in MagstatsStep.assemble(stats, magstats).items():
+        cmd = MagstatsStep.build_command(aid, obj)
+        assert encoder.decode(encoder.encode(cmd)) == cmd
+
+
+def test_avro_encoder_messages_match_compact_scribe_schema():
+    schema = fastavro.schema.load_schema("scribe_schema_compact.avsc")
+    message = AvroPayloadEncoder().encode(command)
+
+    out = io.BytesIO()
+    fastavro.writer(out, schema, [message])
+    out.seek(0)
+    assert list(fastavro.reader(out)) == [message]
+
+
+def test_avro_encoder_rejects_unknown_schema_versions():
+    encoder = AvroPayloadEncoder()
+    message = encoder.encode(command) | {"schema_version": 0}
+
+    with pytest.raises(ValueError):
+        encoder.decode(message)
+
+
+class SlowBrokerClient:
+    # Mimics a client whose broker acknowledges a few messages on each poll, with a bounded local queue
+    def __init__(self, acks_per_poll=3, queue_size=10):
+        self.acks_per_poll = acks_per_poll
+        self.queue_size = queue_size
+        self.pending = []
+        self.delivered = []
+        self.polls = 0
+        self.flushes = 0
+
+    def enqueue(self, message, on_delivery):
+        if len(self.pending) >= self.queue_size:
+            raise BufferError("Local: Queue full")
+        self.pending.append((message, on_delivery))
+
+    def produce(self, topic, value=None, key=None, on_delivery=None):  # As confluent_kafka.Producer
+        self.enqueue((topic, key, value), on_delivery)
+
+    def poll(self, timeout=0):
+        self.polls += 1
+        acked, self.pending = self.pending[: self.acks_per_poll], self.pending[self.acks_per_poll :]
+        for message, on_delivery in acked:
+            self.delivered.append(message)
+            on_delivery(None, message)
+
+    def flush(self):
+        self.flushes += 1
+        while self.pending:
+            self.poll()
+
+
+class SlowBrokerProducer(GenericProducer):
+    def __init__(self, config):
+        super().__init__(config)
+        self.producer = SlowBrokerClient(**config.get("BROKER", {}))
+
+    def produce(self, message=None, **kwargs):
+        self.producer.enqueue(message, kwargs["on_delivery"])
+
+
+class InFlightRecorder(StageMetrics):
+    def __init__(self):
+        self.in_flight, self.retries, self.deliveries = [], 0, 0
+
+    def set_in_flight(self, in_flight):
+        self.in_flight.append(in_flight)
+
+    def count_retry(self):
+        self.retries += 1
+
+    def observe_delivery(self, latency, *, failed=False):
+        self.deliveries += 1
+
+
+def test_flow_controlled_producer_bounds_messages_in_flight():
+    metrics = InFlightRecorder()
+    producer = FlowControlledProducer(SlowBrokerProducer({}), {"MAX_IN_FLIGHT": 5, "BACKOFF": 0}, metrics)
+    for i in range(50):
+        producer.produce({"payload": i})
+    producer.flush()
+
+    assert max(metrics.in_flight) <= 5
+    assert producer.producer.producer.delivered == [{"payload": i} for i in range(50)]
+    assert producer.delivered == metrics.deliveries == 50
+    assert producer.in_flight == 0
+
+
+def test_flow_controlled_producer_retries_when_queue_is_full():
+    metrics = InFlightRecorder()
+    inner = SlowBrokerProducer({"BROKER": {"queue_size": 4, "acks_per_poll": 1}})
+    producer = FlowControlledProducer(inner, {"MAX_IN_FLIGHT": 100, "BACKOFF": 0}, metrics)
+    for i in range(10):
+        producer.produce({"payload": i})
+    producer.flush()
+
+    assert metrics.retries > 0
+    assert inner.producer.delivered == [{"payload": i} for i in range(10)]
+
+
+def test_flow_controlled_producer_raises_after_max_retries():
+    inner = SlowBrokerProducer({"BROKER": {"queue_size": 1, "acks_per_poll": 0}})
+    producer = FlowControlledProducer(inner, {"MAX_IN_FLIGHT": 100, "MAX_RETRIES": 2, "BACKOFF": 0})
+    producer.produce({"payload": 0})
+    with pytest.raises(BufferError):
+        producer.produce({"payload": 1})
+    assert producer.in_flight == 1
+
+
+def test_flow_controlled_producer_retries_full_queues_of_kafka_producers_without_flushing():
+    schema = {"type": "record", "name": "message", "fields": [{"name": "payload", "type": "int"}]}
+    with mock.patch("apf.producers.kafka.Producer", return_value=SlowBrokerClient(queue_size=4, acks_per_poll=1)):
+        inner = KafkaSchemalessProducer({"PARAMS": {}, "SCHEMA": schema, "TOPIC": ["a", "b"]})
+    inner.set_key_field("payload")
+    metrics = InFlightRecorder()
+    producer = FlowControlledProducer(inner, {"MAX_IN_FLIGHT": 100, "BACKOFF": 0}, metrics)
+    for i in range(10):
+        producer.produce({"payload": i})
+    assert metrics.retries > 0 and inner.producer.flushes == 0  # apf would have flushed on the first full queue
+    producer.flush()
+
+    delivered = inner.producer.delivered
+    assert [(topic, key) for topic, key, _ in delivered] == [(topic, i) for i in range(10) for topic in "ab"]
+    assert all(value == inner._serialize_message({"payload": key}) for _, key, value in delivered)
+    assert producer.delivered == 20 and producer.in_flight == 0
+
+
+def test_step_flushes_flow_controlled_producer_on_tear_down(env_variables, monkeypatch):
+    monkeypatch.setenv("SCRIBE_PRODUCER_CLASS", "tests.unittests.test_scribe.SlowBrokerProducer")
+    monkeypatch.setenv("USE_SCRIBE_FLOW_CONTROL", "yes")
+    monkeypatch.setenv("SCRIBE_MAX_IN_FLIGHT", "2")
+    monkeypatch.setenv("SCRIBE_BACKOFF", "0")
+    step = step_factory()
+    step.post_execute(step.execute(step.pre_execute(data)))
+    step.tear_down()
+
+    assert len(step.scribe_producer.client.delivered) == len({msg["aid"] for msg in data})
+    assert step.scribe_producer.in_flight == 0
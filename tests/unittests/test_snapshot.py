@@ -0,0 +1,59 @@
+import struct
+import time
+from collections import OrderedDict
+
+from magstats_step.snapshot import CacheSnapshot
+
+
+def entries(n):
+    return OrderedDict(
+        (f"AID{i}", {"_id": f"AID{i}", "ndet": i, "magstats": [{"fid": 1, "magmean": 1.5}]}) for i in range(n)
+    )
+
+
+def test_snapshot_round_trip_keeps_documents_and_recency_order(tmp_path):
+    snapshot = CacheSnapshot({"PATH": str(tmp_path / "cache.snapshot")})
+    assert snapshot.load() == OrderedDict()  # No snapshot yet
+
+    assert snapshot.save(entries(5)) == 5
+    loaded = snapshot.load()
+    assert loaded == entries(5) and list(loaded) == list(entries(5))
+
+
+def test_snapshot_beyond_size_leaves_out_least_recently_used(tmp_path):
+    snapshot = CacheSnapshot({"PATH": str(tmp_path / "cache.snapshot"), "MAX_BYTES": 300})
+    saved = snapshot.save(entries(10))
+    assert 0 < saved < 10
+    assert (tmp_path / "cache.snapshot").stat().st_size <= 300
+    assert list(snapshot.load()) == list(entries(10))[-saved:]
+
+
+def test_stale_corrupt_and_incompatible_snapshots_are_ignored(tmp_path):
+    path = tmp_path / "cache.snapshot"
+    snapshot = CacheSnapshot({"PATH": str(path), "MAX_AGE": 60})
+    snapshot.save(entries(3))
+    content = path.read_bytes()
+
+    path.write_bytes(content[:-5])
+    assert snapshot.load() == OrderedDict()
+    path.write_bytes(b"")
+    assert snapshot.load() == OrderedDict()
+    path.write_bytes(content[:4] + struct.pack("<H", CacheSnapshot.VERSION + 1) + content[6:])
+    assert snapshot.load() == OrderedDict()
+    path.write_bytes(content[:6] + struct.pack("<d", time.time() - 120) + content[14:])
+    assert snapshot.load() == OrderedDict()
+    path.write_bytes(content)
+    assert len(snapshot.load()) == 3
+
+
+def test_failed_snapshots_are_logged_and_left_out(tmp_path, caplog):
+    (tmp_path / "file").touch()
+    snapshot = CacheSnapshot({"PATH": str(tmp_path / "file" / "cache.snapshot")})  # Parent is not a directory
+    assert snapshot.save(entries(3)) == 0
+    assert not snapshot.due() and "Failed to save snapshot" in caplog.text
+
+    snapshot = CacheSnapshot({"PATH": str(tmp_path / "cache.snapshot")})
+    documents = entries(3)
+    documents["x" * 2**16] = {"ndet": 1}
+    assert snapshot.save(documents) == 3
+    assert snapshot.load() == entries(3)
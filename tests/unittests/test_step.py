@@ -1,10 +1,30 @@
 import json
+import zlib
 from unittest import mock
 
+from apf.producers import GenericProducer
+from prometheus_client import CollectorRegistry
+
 from .data.messages import data
+from magstats_step.inmemory import InMemoryProducer
+from magstats_step.metrics import PrometheusStageMetrics
+from magstats_step.step import MagstatsStep
 from scripts.run_step import step_factory
 
 
+class PartitionedStubProducer(GenericProducer):
+    # Mimics the partition assignment of keyed messages in Kafka, keeping the messages in memory
+    n_partitions = 4
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.partitions = [[] for _ in range(self.n_partitions)]
+
+    def produce(self, message=None, **kwargs):
+        key = message[self.key_field]
+        self.partitions[zlib.crc32(key.encode()) % self.n_partitions].append((key, message["payload"]))
+
+
 def test_execute(env_variables):
     step = step_factory()
     formatted_data = step.pre_execute(data)
@@ -27,7 +47,7 @@ def test_scribe_message(env_variables):
     step = step_factory()
     formatted_data = step.pre_execute(data)
     result = step.execute(formatted_data)
-    # Necessary because creation in step_factory gives dictionary of config which is interpreted as spec for dict
+    # Replaced to keep track of the produced messages
     step.scribe_producer = mock.MagicMock()
 
     step.post_execute(result)
@@ -41,4 +61,266 @@ def test_scribe_message(env_variables):
             "data": to_write,
             "options": {"upsert": True},
         }
-        step.scribe_producer.produce.assert_any_call({"payload": json.dumps(command)})
+        step.scribe_producer.produce.assert_any_call({"payload": json.dumps(command), "aid": d["aid"]})
+
+
+def test_pre_execute_collapses_repeated_history(env_variables):
+    step = step_factory()
+    formatted_data = step.pre_execute(data)
+    repeated = step.pre_execute(data + data[: len(data) // 2])
+    assert repeated == formatted_data
+    assert len({det["candid"] for det in formatted_data["detections"]}) == len(formatted_data["detections"])
+    assert step.execute(repeated) == step.execute(step.pre_execute(data))
+
+
+def test_split_by_aid_keeps_objects_together_and_respects_row_limit():
+    formatted_data = MagstatsStep.pre_execute(data)
+    chunks = list(MagstatsStep.split_by_aid(formatted_data, 40))
+
+    seen = set()
+    for chunk in chunks:
+        aids = {det["aid"] for det in chunk["detections"]}
+        assert not aids & seen
+        seen |= aids
+        assert {nd["aid"] for nd in chunk["non_detections"]} <= aids
+        if len(aids) > 1:
+            assert len(chunk["detections"]) + len(chunk["non_detections"]) <= 40
+    assert seen == {d["aid"] for d in data}
+    assert sum(len(chunk["detections"]) for chunk in chunks) == len(formatted_data["detections"])
+
+
+def test_execute_with_chunks_gives_same_result_as_full_batch(env_variables):
+    step = step_factory()
+    formatted_data = step.pre_execute(data)
+    expected = step.execute(formatted_data)
+
+    step.max_chunk_rows = 40
+    chunks = step.execute(formatted_data)
+    assert not isinstance(chunks, dict)
+
+    result = {}
+    for chunk in chunks:
+        assert not set(chunk) & set(result)
+        result.update(chunk)
+    assert result == expected
+
+
+def test_post_execute_with_chunks_produces_every_object(env_variables):
+    step = step_factory()
+    step.max_chunk_rows = 40
+    formatted_data = step.pre_execute(data)
+    step.scribe_producer = mock.MagicMock()
+
+    step.post_execute(step.execute(formatted_data))
+    assert step.scribe_producer.produce.call_count == len({d["aid"] for d in data})
+
+
+def test_scribe_messages_are_keyed_by_aid_preserving_order_per_partition(env_variables, monkeypatch):
+    monkeypatch.setenv("SCRIBE_PRODUCER_CLASS", "tests.unittests.test_step.PartitionedStubProducer")
+    step = step_factory()
+    result = step.execute(step.pre_execute(data))
+
+    n_batches = 200
+    for batch in range(n_batches):
+        step.produce_scribe({aid: stats | {"ndet": batch} for aid, stats in result.items()})
+
+    partitions = {}
+    for i, partition in enumerate(step.scribe_producer.partitions):
+        for key, payload in partition:
+            assert partitions.setdefault(key, i) == i  # All messages for an aid go to a single partition
+    for aid in result:
+        partition = step.scribe_producer.partitions[partitions[aid]]
+        ndets = [json.loads(payload)["data"]["ndet"] for key, payload in partition if key == aid]
+        assert ndets == list(range(n_batches))
+
+
+def test_warm_up_runs_calculators_before_consuming_without_producing(env_variables, monkeypatch):
+    monkeypatch.setenv("WARM_UP", "yes")
+    step = step_factory()
+    step.scribe_producer = mock.MagicMock()
+    step.calculate = mock.Mock(wraps=step.calculate)
+
+    step.pre_consume()
+    step.calculate.assert_called_once()
+    step.scribe_producer.produce.assert_not_called()
+
+
+def test_startup_time_is_reported_only_for_first_batch(env_variables):
+    step = step_factory()
+    formatted_data = step.pre_execute(data)
+    assert step.startup_time is not None
+
+    step.post_execute(step.execute(formatted_data))
+    assert step.startup_time is None
+
+
+def test_stage_metrics_are_recorded_for_every_stage(env_variables):
+    step = step_factory()
+    step.stage_metrics = PrometheusStageMetrics(CollectorRegistry())
+    step.post_execute(step.execute(step._pre_execute(data)))
+
+    registry = step.stage_metrics.registry
+    for stage in ["pre_execute", "assemble", "produce_scribe"]:
+        assert registry.get_sample_value("magstats_stage_duration_seconds_count", {"stage": stage}) == 1
+    for calculator in ["ObjectStatistics", "MagnitudeStatistics"]:
+        labels = {"calculator": calculator}
+        assert registry.get_sample_value("magstats_calculator_duration_seconds_count", labels) == 1
+    assert registry.get_sample_value("magstats_batch_size_sum", {"kind": "messages"}) == len(data)
+
+
+def test_previous_objects_are_only_read_when_skipping_unchanged_objects(env_variables, monkeypatch):
+    monkeypatch.setenv("USE_OBJECT_READER", "yes")
+    monkeypatch.setenv("OBJECT_READER_CLASS", "magstats_step.readers.InMemoryObjectReader")
+    step = step_factory()
+    step.scribe_producer = InMemoryProducer()
+    for _ in range(2):
+        step.post_execute(step.execute(step._pre_execute(data)))
+    assert step.object_reader.queries == 0
+    n_objects = len({d["aid"] for d in data})
+    assert step.scribe_producer.produced == 2 * n_objects  # Written even if unchanged, unless configured
+
+
+def test_previous_objects_are_read_once_and_cached_once_delivered(env_variables, monkeypatch):
+    monkeypatch.setenv("USE_OBJECT_READER", "yes")
+    monkeypatch.setenv("OBJECT_READER_CLASS", "magstats_step.readers.InMemoryObjectReader")
+    monkeypatch.setenv("SKIP_UNCHANGED_OBJECTS", "yes")
+    step = step_factory()
+    step.scribe_producer = InMemoryProducer()
+
+    step.post_execute(step.execute(step._pre_execute(data)))
+    assert step.object_reader.queries == 1
+    n_objects = step.scribe_producer.produced
+    assert n_objects == len({d["aid"] for d in data})
+
+    step.post_execute(step.execute(step._pre_execute(data)))
+    assert step.object_reader.queries == 1  # Everything comes from the cache
+    assert step.scribe_producer.produced == n_objects  # Unchanged objects are not written again
+
+
+def test_unchanged_objects_are_skipped_only_when_configured_and_after_delivery(env_variables, monkeypatch):
+    monkeypatch.setenv("USE_OBJECT_READER", "yes")
+    monkeypatch.setenv("OBJECT_READER_CLASS", "magstats_step.readers.InMemoryObjectReader")
+    monkeypatch.setenv("SKIP_UNCHANGED_OBJECTS", "yes")
+    step = step_factory()
+    step.scribe_producer = mock.MagicMock()  # Delivery is never reported
+
+    step.post_execute(step.execute(step._pre_execute(data)))
+    n_objects = step.scribe_producer.produce.call_count
+    step.post_execute(step.execute(step._pre_execute(data)))
+    assert step.scribe_producer.produce.call_count == 2 * n_objects
+
+    for call in step.scribe_producer.produce.call_args_list[:n_objects]:  # Failed deliveries
+        call.kwargs["on_delivery"]("broker down", None)
+    step.post_execute(step.execute(step._pre_execute(data)))
+    assert step.scribe_producer.produce.call_count == 3 * n_objects
+
+    for call in step.scribe_producer.produce.call_args_list[n_objects:]:
+        call.kwargs["on_delivery"](None, None)
+    step.post_execute(step.execute(step._pre_execute(data)))
+    assert step.scribe_producer.produce.call_count == 3 * n_objects
+
+
+def test_execute_adds_windowed_magstats_when_configured(env_variables, monkeypatch):
+    monkeypatch.setenv("MAGSTATS_WINDOWS", "7,30")
+    step = step_factory()
+    result = step.execute(step.pre_execute(data))
+    for stats in result.values():
+        for magstats in stats["magstats"]:
+            assert {"ndet_7d", "magmean_7d", "magmin_30d", "magmax_30d"} <= magstats.keys()
+
+
+def test_concurrent_calculators_give_same_result_as_sequential(env_variables, monkeypatch):
+    messages = MagstatsStep.pre_execute(data)
+    expected = step_factory().execute(messages)
+
+    monkeypatch.setenv("CALCULATOR_THREADS", "4")
+    step = step_factory()
+    result = step.execute(messages)
+    step.executor.shutdown()
+
+    assert list(result) == list(expected)
+    for aid in expected:
+        assert list(result[aid]) == list(expected[aid])  # Same field order
+        assert result[aid] == expected[aid]
+
+
+def test_compact_metrics_aggregate_batch_with_bounded_aid_sample(env_variables):
+    step = step_factory()
+    assert step.get_extra_metrics(data)["aid"] == [d["aid"] for d in data]
+
+    step.compact_metrics = {"AID_SAMPLE": 3}
+    metrics = step.get_extra_metrics(data)
+    aids = {d["aid"] for d in data}
+    assert metrics["n_messages"] == len(data) and metrics["n_aids"] == len(aids)
+    assert len(metrics["aid_sample"]) == 3 and set(metrics["aid_sample"]) <= aids
+    assert metrics["n_detections"] == sum(len(d["detections"]) for d in data)
+    assert metrics["n_non_detections"] == sum(len(d["non_detections"]) for d in data)
+    assert metrics["n_detections"] == sum(metrics["detections_by_survey"].values())
+    assert metrics["detections_by_survey"] == {
+        sid: sum(bands.values()) for sid, bands in metrics["detections_by_band"].items()
+    }
+    assert "aid" not in metrics
+
+
+def test_cache_of_previous_objects_is_loaded_back_after_restart(env_variables, monkeypatch, tmp_path):
+    monkeypatch.setenv("USE_OBJECT_READER", "yes")
+    monkeypatch.setenv("OBJECT_READER_CLASS", "magstats_step.readers.InMemoryObjectReader")
+    monkeypatch.setenv("CACHE_SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setenv("SKIP_UNCHANGED_OBJECTS", "yes")
+    step = step_factory()
+    step.scribe_producer = InMemoryProducer()
+    step.post_execute(step.execute(step._pre_execute(data)))
+    step.tear_down()
+    assert (tmp_path / "objects-0.snapshot").exists()
+
+    restarted = step_factory()
+    restarted.scribe_producer = mock.MagicMock()
+    assert restarted.object_reader.entries() == step.object_reader.entries()
+    restarted.post_execute(restarted.execute(restarted._pre_execute(data)))
+    assert restarted.object_reader.queries == 0
+    restarted.scribe_producer.produce.assert_not_called()
+
+
+def test_failed_snapshots_do_not_stop_the_step(env_variables, monkeypatch, tmp_path):
+    monkeypatch.setenv("USE_OBJECT_READER", "yes")
+    monkeypatch.setenv("OBJECT_READER_CLASS", "magstats_step.readers.InMemoryObjectReader")
+    (tmp_path / "file").touch()
+    monkeypatch.setenv("CACHE_SNAPSHOT_DIR", str(tmp_path / "file"))  # Not a directory, every save fails
+    monkeypatch.setenv("CACHE_SNAPSHOT_EVERY", "0")
+    step = step_factory()
+    step.consumer = mock.MagicMock()
+    step.metrics_sender = mock.MagicMock()
+    step.scribe_producer = InMemoryProducer()
+    step._post_execute(step.execute(step._pre_execute(data)))
+    step.consumer.commit.assert_called_once()
+    step.tear_down()
+
+
+def test_stop_while_waiting_for_messages_tears_down_the_step(env_variables, monkeypatch, tmp_path):
+    step = step_factory()
+    monkeypatch.chdir(tmp_path)  # Tear down writes __SUCCESS__
+
+    def batches():
+        yield data
+        step.stop()  # Signal received while waiting for the next batch
+        yield data
+
+    step.consumer, step.metrics_sender = mock.MagicMock(), mock.MagicMock()
+    step.consumer.consume.return_value = batches()
+    with mock.patch.object(step, "tear_down") as tear_down, mock.patch.object(step, "produce_scribe") as produce:
+        step.start()
+    assert produce.call_count == 1
+    tear_down.assert_called_once()
+
+
+def test_stop_during_batch_finishes_it_before_tearing_down(env_variables, monkeypatch, tmp_path):
+    step = step_factory()
+    monkeypatch.chdir(tmp_path)
+    step.consumer, step.metrics_sender = mock.MagicMock(), mock.MagicMock()
+    step.consumer.consume.return_value = iter([data, data])
+    with mock.patch.object(step, "tear_down") as tear_down, mock.patch.object(step, "produce_scribe") as produce:
+        produce.side_effect = lambda result: step.stop()
+        step.start()
+    assert produce.call_count == 1
+    step.consumer.commit.assert_called_once()
+    tear_down.assert_called_once()
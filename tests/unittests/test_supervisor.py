@@ -0,0 +1,84 @@
+import functools
+import os
+import signal
+import threading
+import time
+
+from magstats_step.supervisor import Supervisor
+
+config = {"WORKERS": 2, "RESTART_DELAY": 0, "CHECK_EVERY": 0.05, "STOP_TIMEOUT": 1}
+
+
+def crash_once(path, index, heartbeat):
+    marker = os.path.join(path, str(index))
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+
+
+def hang_once(path, index, heartbeat):
+    marker = os.path.join(path, str(index))
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        time.sleep(60)  # Never beats again
+
+
+def run_forever(index, heartbeat):
+    while True:
+        heartbeat.value = time.time()
+        time.sleep(0.01)
+
+
+def stop_on_sigterm(path, index, heartbeat):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    while not stopping:
+        heartbeat.value = time.time()
+        time.sleep(0.01)
+    open(os.path.join(path, str(index)), "w").close()  # Stands for the tear down of the step
+
+
+def test_supervisor_restarts_crashed_workers_until_they_finish(tmp_path):
+    supervisor = Supervisor(functools.partial(crash_once, str(tmp_path)), config)
+    supervisor.run()
+    assert supervisor.restarts == 2
+    assert not supervisor.workers
+
+
+def test_supervisor_restarts_workers_without_heartbeat(tmp_path):
+    supervisor = Supervisor(functools.partial(hang_once, str(tmp_path)), config | {"HEARTBEAT_TIMEOUT": 0.3})
+    start = time.time()
+    supervisor.run()
+    assert supervisor.restarts == 2
+    assert time.time() - start < 10
+
+
+def test_supervisor_stops_all_workers():
+    supervisor = Supervisor(run_forever, config | {"HEARTBEAT_TIMEOUT": 5})
+    for index in range(supervisor.n_workers):
+        supervisor._start(index)
+    processes = [process for process, _ in supervisor.workers.values()]
+    supervisor.check()
+    assert all(process.is_alive() for process in processes) and supervisor.restarts == 0
+
+    supervisor.shutdown()
+    assert not any(process.is_alive() for process in processes)
+    assert not supervisor.workers
+
+
+def test_sigterm_to_supervisor_stops_workers_without_waiting_for_timeout(tmp_path):
+    supervisor = Supervisor(functools.partial(stop_on_sigterm, str(tmp_path)), config | {"STOP_TIMEOUT": 5})
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    start = time.time()
+    supervisor.run()
+    assert time.time() - start < 3
+    assert sorted(os.listdir(tmp_path)) == ["0", "1"]  # Workers stopped through their own handlers
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+
+
+def test_sigterm_to_supervisor_terminates_workers_with_default_handlers():
+    supervisor = Supervisor(run_forever, config | {"STOP_TIMEOUT": 5})
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    start = time.time()
+    supervisor.run()
+    assert time.time() - start < 3  # Not killed after the timeout